@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import functools
+import http.server
+import json
+import os.path
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from PIL import Image
+
+from fakes import FakeDrive, StubRenderer
+from sheet_source import write_snapshot
+from utils import ArgumentParser
+
+SHEET_ID = 'benchmark'
+SHEET_RANGE = 'Placards!A2:H'
+ROOT_FOLDER_NAME = 'Placards'
+STYLES = ['IPA', 'Hazy IPA', 'Pilsner', 'Stout', 'Imperial Stout',
+          'Sour', 'Amber Ale', 'Barleywine', 'Saison', 'Porter']
+# (width, height, format) of the generated logo fixtures
+LOGO_FIXTURES = [(320, 240, 'PNG'), (640, 640, 'JPEG'), (1800, 900, 'PNG'),
+                 (500, 1200, 'JPEG'), (2400, 2400, 'JPEG'), (256, 256, 'WEBP')]
+
+parser = ArgumentParser()
+parser.add_argument('--bench_rows', default=[10, 100, 1000], type=int, nargs='+',
+                    help='Sizes of the synthetic sheets to benchmark')
+parser.add_argument('--bench_output', default=None,
+                    help='File to write the JSON results to (defaults to stdout)')
+parser.add_argument('--bench_dir', default=None,
+                    help='Directory to run in (defaults to a temporary one that is removed afterwards)')
+# Used by the benchmark to run one scenario in a fresh process
+parser.add_argument('--bench_child', default=None, help=argparse.SUPPRESS)
+
+
+def make_logo_fixtures(logo_dir):
+    os.makedirs(logo_dir, exist_ok=True)
+    names = []
+    for i, (width, height, format) in enumerate(LOGO_FIXTURES):
+        image = Image.new('RGB', (width, height), (40 * i % 256, 90, 160))
+        for y in range(0, height, 16):
+            image.paste((255, 255 - y % 256, 0), (0, y, width, y + 4))
+        name = f'logo{i}.{format.lower()}'
+        image.save(os.path.join(logo_dir, name), format=format)
+        names.append(name)
+    return names
+
+
+def make_sheet(rows, logo_base_url, logo_names):
+    """A deterministic synthetic Placards sheet with varied ABVs, font size
+    overrides and logos (some missing)."""
+    rng = random.Random(rows)
+    sheet = []
+    for i in range(rows):
+        logo_url = '' if rng.random() < 0.1 else f'{logo_base_url}/{rng.choice(logo_names)}'
+        sheet.append([
+            f'Brewer {i % 37}',
+            f'Beer {i}',
+            rng.choice(STYLES),
+            f'{rng.uniform(3.5, 14):.1f}',
+            logo_url,
+            rng.choice(['', '', '', '18']),
+            rng.choice(['', '', '', '', '24']),
+            rng.choice(['', '', '14']),
+        ])
+    return sheet
+
+
+@contextlib.contextmanager
+def _serve(directory):
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _Stages:
+    def __init__(self):
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        (_, peak) = tracemalloc.get_traced_memory()
+        self.results[name] = {'seconds': round(seconds, 6), 'peak_bytes': peak}
+
+
+def run_scenario(config):
+    """Runs the pipeline once in the current directory, in this process."""
+    # Imported here so that nothing is created before the working directory
+    # is set up
+    import gcloud_helper
+    from logo_cache import get_logo_cache
+    from multiprint import create_imposed_pdf, create_multiprint_pdf
+    from placard import GoldPan
+    from render_store import get_render_store
+    from renderer import set_renderer
+    from sheet_source import SnapshotSheetSource, pad_rows
+    from utils import file_hashes
+
+    renderer = StubRenderer()
+    set_renderer(renderer)
+    drive_path = os.path.join(os.curdir, 'fake_drive.json')
+    drive = FakeDrive.load(drive_path) if os.path.isfile(drive_path) else FakeDrive()
+    roots = drive.list(f"name='{ROOT_FOLDER_NAME}' and trashed=false")
+    root_id = roots[0]['id'] if roots else drive.add_folder(ROOT_FOLDER_NAME)
+
+    prepared_dir = os.path.join(os.curdir, 'prepared')
+    os.makedirs(prepared_dir, exist_ok=True)
+    file_hashes.load(os.path.join(prepared_dir, 'file_hashes.json'))
+    site = GoldPan(prepared_dir)
+    gcloud = gcloud_helper.GCloud(root_id, [site], drive=drive)
+    sheet_source = SnapshotSheetSource(config['sheet_path'])
+    stages = _Stages()
+    tracemalloc.start()
+
+    with stages.stage('sheet'):
+        rows = pad_rows(sheet_source.read([(SHEET_ID, SHEET_RANGE)])[(SHEET_ID, SHEET_RANGE)], 8)
+    with stages.stage('restore'):
+        restored = [site.restore_placard(row) for row in rows]
+    dirty = [row for row, placard in zip(rows, restored) if placard is None]
+    with stages.stage('logos'):
+        get_logo_cache().prefetch([row[4] for row in dirty])
+    with stages.stage('prepare'):
+        prepared = {}
+        for row in dirty:
+            prepared[id(row)] = site.build_placard(*row)
+            site.record_placard(row, prepared[id(row)])
+    with stages.stage('hashes'):
+        # The full change detection that restored rows skip
+        for row, placard in zip(rows, restored):
+            if placard is not None:
+                site.build_placard(*row)
+    site.prepared_placards = [placard if placard is not None else prepared[id(row)]
+                              for row, placard in zip(rows, restored)]
+    file_hashes.save()
+    get_logo_cache().save()
+    get_render_store().prune()
+
+    with stages.stage('multiprint'):
+        create_multiprint_pdf([placard.output_files['SVG'].file_path
+                               for placard in site.prepared_placards])
+    with stages.stage('impose'):
+        create_imposed_pdf([placard.output_files['PDF'].file_path
+                            for placard in site.prepared_placards])
+    with stages.stage('sync'):
+        gcloud.upload()
+    tracemalloc.stop()
+    drive.save(drive_path)
+
+    return {
+        'rows': len(rows),
+        'scenario': config['scenario'],
+        'dirty_rows': len(dirty),
+        'renders': renderer.renders,
+        'drive_calls': dict(sorted(drive.calls.items())),
+        'stages': stages.results,
+        'total_seconds': round(sum(stage['seconds'] for stage in stages.results.values()), 6),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _child(config_path):
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    os.chdir(config['dir'])
+    result = run_scenario(config)
+    with open(config['result_path'], 'w') as f:
+        json.dump(result, f)
+
+
+def main():
+    args = parser.parse_args()
+    if args.bench_child is not None:
+        _child(args.bench_child)
+        return
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    bench_dir = args.bench_dir or tempfile.mkdtemp(prefix='placgen-bench-')
+    results = []
+    try:
+        logo_dir = os.path.join(bench_dir, 'logos')
+        logo_names = make_logo_fixtures(logo_dir)
+        with _serve(logo_dir) as logo_base_url:
+            for rows in args.bench_rows:
+                run_dir = os.path.join(bench_dir, f'rows_{rows}')
+                shutil.rmtree(run_dir, ignore_errors=True)
+                shutil.copytree(os.path.join(repo_dir, 'templates'),
+                                os.path.join(run_dir, 'templates'))
+                # The synthetic sheet is a snapshot, like --sheet_snapshot reads
+                sheet_path = os.path.join(run_dir, 'sheet.json')
+                write_snapshot(sheet_path, {(SHEET_ID, SHEET_RANGE): make_sheet(
+                    rows, logo_base_url, logo_names)})
+                # Cold starts from nothing, warm runs again with nothing changed.
+                # Each gets a fresh process so that nothing is cached in memory.
+                for scenario in ['cold', 'warm']:
+                    print(f'{rows} rows, {scenario}', file=sys.stderr)
+                    config_path = os.path.join(run_dir, f'{scenario}.json')
+                    result_path = os.path.join(run_dir, f'{scenario}_result.json')
+                    with open(config_path, 'w') as f:
+                        json.dump({'dir': run_dir, 'scenario': scenario, 'sheet_path': sheet_path,
+                                   'result_path': result_path}, f)
+                    subprocess.run([sys.executable, os.path.join(repo_dir, 'benchmark.py'),
+                                    '--bench_child', config_path],
+                                   cwd=run_dir, check=True, stdout=subprocess.DEVNULL)
+                    with open(result_path, 'r') as f:
+                        results.append(json.load(f))
+    finally:
+        if args.bench_dir is None:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    report = {
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+    if args.bench_output is not None:
+        with open(args.bench_output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+
+
+if __name__ == '__main__':
+    main()
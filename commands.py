@@ -0,0 +1,66 @@
+import os.path
+import subprocess
+import tempfile
+from typing import List
+
+from utils import status
+
+# How much of a command's output is kept for its error
+ERROR_OUTPUT_CHARS = 2000
+
+
+def _tail(output: str) -> str:
+    output = output.strip()
+    return output if len(output) <= ERROR_OUTPUT_CHARS else '...' + output[-ERROR_OUTPUT_CHARS:]
+
+
+class Process:
+    """A command started by start().  Its stderr is kept in a temporary
+    file (a pipe could fill up and block a long-lived process) so that it
+    can be reported when the command fails."""
+
+    def __init__(self, argv: List[str], cwd: str = None):
+        self.argv = argv
+        self.name = os.path.basename(argv[0])
+        self.__stderr = tempfile.TemporaryFile()
+        try:
+            self.__popen = subprocess.Popen(argv, cwd=cwd, stdin=subprocess.DEVNULL,
+                                            stdout=subprocess.DEVNULL, stderr=self.__stderr)
+        except OSError as e:
+            self.__stderr.close()
+            raise Exception(f'Failed to run {self.name}: {e}') from e
+
+    @property
+    def returncode(self):
+        return self.__popen.returncode
+
+    def poll(self):
+        return self.__popen.poll()
+
+    def wait(self, timeout: float = None):
+        return self.__popen.wait(timeout)
+
+    def stop(self, timeout: float = 5):
+        """Terminates the command, killing it if it doesn't exit within
+        timeout seconds."""
+        if self.__popen.poll() is None:
+            self.__popen.terminate()
+            try:
+                self.__popen.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.__popen.kill()
+                self.__popen.wait()
+        self.__stderr.close()
+
+    def stderr(self) -> str:
+        """The end of what the command has written to stderr so far."""
+        self.__stderr.seek(0)
+        return _tail(self.__stderr.read().decode('utf8', errors='replace'))
+
+
+def start(argv: List[str], cwd: str = None) -> Process:
+    """Starts argv (no shell, so arguments need no quoting) without waiting
+    for it.  For long-lived processes, which are the caller's to stop()."""
+    argv = [str(arg) for arg in argv]
+    with status.span(f'Starting {os.path.basename(argv[0])}', command=' '.join(argv)):
+        return Process(argv, cwd)
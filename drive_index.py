@@ -0,0 +1,165 @@
+import os.path
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+-- listed is set once every file in the folder has been indexed
+CREATE TABLE IF NOT EXISTS folders (
+    parent_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    id TEXT NOT NULL,
+    listed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (parent_id, name)
+);
+CREATE INDEX IF NOT EXISTS folders_by_id ON folders (id);
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    folder_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    md5 TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_folder ON files (folder_id, mime_type);
+'''
+
+
+class DriveIndex:
+    """Local copy of the Drive folders and files we upload to.
+
+    Keeps folder ids by (parent, name) and every file's id, name and md5
+    property per folder, along with the Drive changes page token the index is
+    current as of.  Feeding it the changes since that token brings it up to
+    date without listing anything.
+    """
+
+    def __init__(self, index_path: str):
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(index_path, check_same_thread=False)
+        with self.__lock, self.__db:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.executescript(SCHEMA)
+
+    def __get_meta(self, key: str) -> Optional[str]:
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def page_token(self, root_folder_id: str) -> Optional[str]:
+        """The changes page token, if the index is for root_folder_id."""
+        if self.__get_meta('root_folder_id') != root_folder_id:
+            return None
+        return self.__get_meta('page_token')
+
+    def reset(self, root_folder_id: str, page_token: str):
+        """Forgets everything, starting over from page_token."""
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM folders')
+            self.__db.execute('DELETE FROM files')
+            self.__db.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [
+                ('root_folder_id', root_folder_id), ('page_token', page_token)])
+
+    def folder_id(self, parent_id: str, name: str) -> Optional[str]:
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT id FROM folders WHERE parent_id = ? AND name = ?', (parent_id, name)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_folder(self, parent_id: str, name: str, id: str):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO folders (parent_id, name, id) VALUES (?, ?, ?)', (parent_id, name, id))
+
+    def is_listed(self, folder_id: str) -> bool:
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT listed FROM folders WHERE id = ?', (folder_id,)).fetchone()
+        return row is not None and row[0] == 1
+
+    def replace_folder_files(self, folder_id: str, mime_type: str, items: List[dict]):
+        """Stores the result of a full listing of folder_id."""
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'DELETE FROM files WHERE folder_id = ? AND mime_type = ?', (folder_id, mime_type))
+            self.__db.executemany(
+                'INSERT OR REPLACE INTO files (id, folder_id, name, mime_type, md5) VALUES (?, ?, ?, ?, ?)',
+                [(item['id'], folder_id, item['name'], mime_type, _md5_property(item)) for item in items])
+            self.__db.execute(
+                'UPDATE folders SET listed = 1 WHERE id = ?', (folder_id,))
+
+    def folder_files(self, folder_id: str, mime_type: str) -> List[Dict]:
+        """Files in folder_id, shaped like a Drive files.list item."""
+        with self.__lock:
+            rows = self.__db.execute(
+                'SELECT id, name, md5 FROM files WHERE folder_id = ? AND mime_type = ? ORDER BY name, id',
+                (folder_id, mime_type)).fetchall()
+        items = []
+        for (id, name, md5) in rows:
+            item = {'id': id, 'name': name}
+            if md5 is not None:
+                item['properties'] = {'md5': md5}
+            items.append(item)
+        return items
+
+    def put_file(self, id: str, folder_id: str, name: str, mime_type: str, md5: str):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO files (id, folder_id, name, mime_type, md5) VALUES (?, ?, ?, ?, ?)',
+                (id, folder_id, name, mime_type, md5))
+
+    def apply_changes(self, changes: List[dict], page_token: str):
+        """Applies a batch of Drive changes and moves the index to page_token."""
+        with self.__lock, self.__db:
+            folder_ids = set(id for (id,) in self.__db.execute(
+                'SELECT id FROM folders').fetchall())
+            for change in changes:
+                id = change['fileId']
+                file = change.get('file')
+                if change.get('removed') or file is None or file.get('trashed'):
+                    self.__forget(id)
+                    continue
+
+                parents = file.get('parents', [])
+                if file.get('mimeType') == FOLDER_MIME_TYPE:
+                    # A folder we know that was renamed or moved is looked up again
+                    for (parent_id, name) in self.__db.execute(
+                            'SELECT parent_id, name FROM folders WHERE id = ?', (id,)).fetchall():
+                        if name != file.get('name') or parent_id not in parents:
+                            self.__forget(id)
+                    continue
+
+                folder_id = next(
+                    (parent for parent in parents if parent in folder_ids), None)
+                if folder_id is None:
+                    self.__db.execute('DELETE FROM files WHERE id = ?', (id,))
+                else:
+                    self.__db.execute(
+                        'INSERT OR REPLACE INTO files (id, folder_id, name, mime_type, md5) VALUES (?, ?, ?, ?, ?)',
+                        (id, folder_id, file['name'], file.get('mimeType'), _md5_property(file)))
+            self.__db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('page_token', ?)", (page_token,))
+
+    def __forget(self, id: str):
+        # Called with the lock held, inside a transaction.  Forgetting a
+        # folder forgets everything known to be inside it.
+        self.__db.execute('DELETE FROM files WHERE id = ?', (id,))
+        self.__db.execute('DELETE FROM files WHERE folder_id = ?', (id,))
+        children = self.__db.execute(
+            'SELECT id FROM folders WHERE parent_id = ?', (id,)).fetchall()
+        self.__db.execute(
+            'DELETE FROM folders WHERE id = ? OR parent_id = ?', (id, id))
+        for (child_id,) in children:
+            self.__forget(child_id)
+
+
+def _md5_property(item: dict) -> Optional[str]:
+    return item.get('properties', {}).get('md5')
@@ -0,0 +1,250 @@
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from typing import Dict, List
+
+import httplib2
+from googleapiclient.errors import HttpError
+from PIL import Image
+from PyPDF2 import PdfWriter
+
+from drive_index import FOLDER_MIME_TYPE
+from renderer import Renderer
+
+
+class _FakeRequest:
+    def __init__(self, run):
+        self.__run = run
+
+    def execute(self):
+        return self.__run()
+
+
+class FakeDrive:
+    """In-memory stand-in for the Drive v3 service, enough for GCloud.
+
+    Supports the files().list/get/create/update calls and the changes feed
+    that GCloud makes, and counts every call so that runs can be compared.  Pass
+    it to GCloud(..., drive=FakeDrive()) to sync without a network.
+    Changes older than expire_token() are forgotten, like Drive does with
+    old page tokens.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__items: Dict[str, dict] = {}
+        self.__content: Dict[str, str] = {}
+        self.__changes: List[str] = []
+        self.__oldest_token = 0
+        self.__next_id = 0
+        self.calls: Dict[str, int] = {}
+
+    @staticmethod
+    def load(path: str):
+        """A FakeDrive with the contents save()d to path, so that a fake
+        Drive can outlive the process."""
+        drive = FakeDrive()
+        with open(path, 'r') as f:
+            state = json.load(f)
+        drive.__items = state['items']
+        drive.__content = state['content']
+        drive.__changes = state['changes']
+        drive.__oldest_token = state['oldest_token']
+        drive.__next_id = state['next_id']
+        return drive
+
+    def save(self, path: str):
+        with self.__lock:
+            state = {'items': self.__items, 'content': self.__content, 'changes': self.__changes,
+                     'oldest_token': self.__oldest_token, 'next_id': self.__next_id}
+            temp_path = f'{path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_path, path)
+
+    def files(self):
+        return _FakeFiles(self)
+
+    def changes(self):
+        return _FakeChanges(self)
+
+    def count(self, method: str):
+        with self.__lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def add_folder(self, name: str, parent_id: str = None) -> str:
+        return self.create({'name': name, 'mimeType': FOLDER_MIME_TYPE,
+                            'parents': [parent_id] if parent_id else []})['id']
+
+    def create(self, body: dict, media_body=None) -> dict:
+        with self.__lock:
+            self.__next_id += 1
+            id = f'fake{self.__next_id}'
+            item = {'id': id, 'name': body['name'],
+                    'mimeType': body.get('mimeType') or (media_body.mimetype() if media_body else None),
+                    'parents': list(body.get('parents', [])), 'trashed': False, 'version': '1'}
+            if 'properties' in body:
+                item['properties'] = dict(body['properties'])
+            self.__items[id] = item
+            self.__set_content(id, media_body)
+            self.__changes.append(id)
+            return {'id': id}
+
+    def update(self, id: str, body: dict = None, media_body=None) -> dict:
+        with self.__lock:
+            item = self.__items[id]
+            for (key, value) in (body or {}).items():
+                item[key] = dict(value) if isinstance(value, dict) else value
+            item['version'] = str(int(item.get('version', '0')) + 1)
+            self.__set_content(id, media_body)
+            self.__changes.append(id)
+            return {'id': id}
+
+    def get(self, id: str) -> dict:
+        with self.__lock:
+            if id not in self.__items:
+                raise HttpError(httplib2.Response({'status': 404}),
+                                b'{"error": {"message": "File not found"}}')
+            return dict(self.__items[id])
+
+    def trash(self, id: str):
+        self.update(id, {'trashed': True})
+
+    def content_md5(self, id: str) -> str:
+        with self.__lock:
+            return self.__content.get(id)
+
+    def __set_content(self, id: str, media_body):
+        # Called with the lock held
+        if media_body is None:
+            return
+        data = media_body.getbytes(0, media_body.size())
+        self.__content[id] = hashlib.md5(data).hexdigest()
+
+    def list(self, q: str) -> List[dict]:
+        with self.__lock:
+            items = list(self.__items.values())
+        for (field, value) in re.findall(r"(mimeType|name)\s*=\s*['\"]([^'\"]*)['\"]", q):
+            items = [item for item in items if item.get(field) == value]
+        for parent in re.findall(r"parents in '([^']*)'", q):
+            items = [item for item in items if parent in item['parents']]
+        if 'trashed=false' in q.replace(' ', ''):
+            items = [item for item in items if not item['trashed']]
+        return sorted(items, key=lambda item: item['id'])
+
+    def start_page_token(self) -> str:
+        with self.__lock:
+            return str(len(self.__changes))
+
+    def expire_token(self):
+        with self.__lock:
+            self.__oldest_token = len(self.__changes)
+
+    def changes_since(self, token: str, page_size: int) -> dict:
+        with self.__lock:
+            start = int(token)
+            if start < self.__oldest_token or start > len(self.__changes):
+                raise HttpError(httplib2.Response({'status': 404}),
+                                b'{"error": {"message": "Invalid page token"}}')
+            ids = self.__changes[start:start + page_size]
+            end = start + len(ids)
+            changes = [{'fileId': id, 'removed': False, 'file': dict(self.__items[id])}
+                       for id in ids]
+            if end < len(self.__changes):
+                return {'changes': changes, 'nextPageToken': str(end)}
+            return {'changes': changes, 'newStartPageToken': str(end)}
+
+
+def _page(items: List[dict], page_token: str, page_size: int) -> dict:
+    start = int(page_token or 0)
+    result = {'files': items[start:start + page_size]}
+    if start + page_size < len(items):
+        result['nextPageToken'] = str(start + page_size)
+    return result
+
+
+class _FakeFiles:
+    def __init__(self, drive: FakeDrive):
+        self.__drive = drive
+
+    def list(self, q: str = '', pageSize: int = 100, pageToken: str = None, **kwargs):
+        def run():
+            self.__drive.count('files.list')
+            return _page(self.__drive.list(q), pageToken, pageSize)
+        return _FakeRequest(run)
+
+    def get(self, fileId: str, **kwargs):
+        def run():
+            self.__drive.count('files.get')
+            return self.__drive.get(fileId)
+        return _FakeRequest(run)
+
+    def create(self, body: dict, media_body=None, **kwargs):
+        def run():
+            self.__drive.count('files.create')
+            return self.__drive.create(body, media_body)
+        return _FakeRequest(run)
+
+    def update(self, fileId: str, body: dict = None, media_body=None, **kwargs):
+        def run():
+            self.__drive.count('files.update')
+            return self.__drive.update(fileId, body, media_body)
+        return _FakeRequest(run)
+
+
+class _FakeChanges:
+    def __init__(self, drive: FakeDrive):
+        self.__drive = drive
+
+    def getStartPageToken(self, **kwargs):
+        def run():
+            self.__drive.count('changes.getStartPageToken')
+            return {'startPageToken': self.__drive.start_page_token()}
+        return _FakeRequest(run)
+
+    def list(self, pageToken: str, pageSize: int = 100, **kwargs):
+        def run():
+            self.__drive.count('changes.list')
+            return self.__drive.changes_since(pageToken, pageSize)
+        return _FakeRequest(run)
+
+
+class StubRenderer(Renderer):
+    """Stands in for the Chrome render pool: blank PNGs of the requested size
+    and blank PDF pages, so that everything but the browser can be run (and
+    measured) without one."""
+    name = 'stub'
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pngs = {}
+        self.renders = 0
+
+    def __png(self, size):
+        with self.__lock:
+            if size not in self.__pngs:
+                output = io.BytesIO()
+                Image.new('RGB', (size, size), 'white').save(output, format='PNG')
+                self.__pngs[size] = output.getvalue()
+            return self.__pngs[size]
+
+    def render_bytes(self, svg_path, window_size=None, pdf=False, pdf_options=None):
+        with self.__lock:
+            self.renders += 1
+        png_data = self.__png(window_size) if window_size is not None else None
+        pdf_data = None
+        if pdf:
+            options = pdf_options or {}
+            with open(svg_path, 'r', encoding='utf-8') as f:
+                pages = max(1, f.read().count('class="page"'))
+            writer = PdfWriter()
+            for _ in range(pages):
+                writer.add_blank_page(options.get('paperWidth', 8.5) * 72,
+                                      options.get('paperHeight', 11) * 72)
+            output = io.BytesIO()
+            writer.write(output)
+            pdf_data = output.getvalue()
+        return (png_data, pdf_data)
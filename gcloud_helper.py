@@ -2,16 +2,22 @@
 
 from __future__ import print_function
 
+import concurrent.futures
+import copy
+import json
 import os.path
 import os
+import random
+import threading
+import time
 from typing import Dict, List
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+# The Google API client libraries are slow to import, so they are only
+# imported by the code paths that talk to Google.
 
+from drive_index import DriveIndex
+from manifest import get_manifest
+from sheet_source import SheetRange, SheetSource
 from utils import OutputFile, PreparedPlacard, Site, status, ArgumentParser
 
 # If modifying these scopes, delete the file token.json.
@@ -23,7 +29,126 @@ SCOPES = [
 
 PAGE_SIZE = 150
 
+# Drive answers with these when it wants us to slow down
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+MAX_RETRIES = 6
+# Files that may be queued for upload, per upload job
+UPLOAD_QUEUE_PER_JOB = 4
+
 parser = ArgumentParser()
+parser.add_argument('--upload_jobs', default=8, type=int,
+                    help='Number of files uploaded to Google Drive concurrently')
+
+
+def _is_retryable(error) -> bool:
+    if error.resp.status in RETRYABLE_STATUSES:
+        return True
+    if error.resp.status == 403:
+        content = error.content.decode('utf8', 'replace') if isinstance(
+            error.content, bytes) else str(error.content)
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+def _execute_with_backoff(make_request):
+    """Executes the request built by make_request, rebuilding and retrying it
+    with exponential backoff (plus jitter) while Drive is rate limiting."""
+    from googleapiclient.errors import HttpError
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return make_request().execute()
+        except HttpError as e:
+            if attempt == MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = min(2 ** attempt, 32) + random.random()
+            status.write(
+                f'Drive returned {e.resp.status}, retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+
+class UploadResult:
+    UNCHANGED = 'unchanged'
+    CREATED = 'created'
+    UPDATED = 'updated'
+    FAILED = 'failed'
+
+    def __init__(self, site_name: str, file_name: str, action: str, error: Exception = None):
+        self.site_name = site_name
+        self.file_name = file_name
+        self.action = action
+        self.error = error
+
+
+class GoogleSheetSource(SheetSource):
+    """Rows straight from Google Sheets, read with one batchGet per
+    spreadsheet.
+
+    Given a drive_factory, the values read are kept in cache_path along
+    with the spreadsheet's Drive version, which changes with every edit, so
+    that an unchanged spreadsheet costs a single metadata request instead of
+    a read of every range.  Without one (runs that don't otherwise use
+    Drive) every range is read.
+    """
+
+    def __init__(self, sheets_factory, drive_factory, cache_path: str):
+        self.__sheets_factory = sheets_factory
+        self.__drive_factory = drive_factory
+        self.__cache_path = cache_path
+        self.__cache = {}
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'r') as f:
+                self.__cache = json.load(f)
+
+    def __version(self, spreadsheet_id: str):
+        if self.__drive_factory is None:
+            return None
+        from googleapiclient.errors import HttpError
+        try:
+            files = self.__drive_factory().files()
+            return _execute_with_backoff(lambda: files.get(
+                fileId=spreadsheet_id, fields='version', supportsAllDrives=True)).get('version')
+        except HttpError as e:
+            # Not knowing the version only costs a read of the ranges
+            status.write(f'Unable to get the version of spreadsheet {spreadsheet_id}: {e}')
+            return None
+
+    def read(self, ranges: List[SheetRange]) -> Dict[SheetRange, List[List[str]]]:
+        by_spreadsheet: Dict[str, List[str]] = {}
+        for (spreadsheet_id, range_name) in ranges:
+            by_spreadsheet.setdefault(spreadsheet_id, []).append(range_name)
+
+        values = {}
+        for spreadsheet_id, range_names in by_spreadsheet.items():
+            version = self.__version(spreadsheet_id)
+            cached = self.__cache.get(spreadsheet_id)
+            if (version is not None and cached is not None and cached['version'] == version
+                    and all(range_name in cached['ranges'] for range_name in range_names)):
+                status.write(f'Spreadsheet {spreadsheet_id} unchanged since it was last read')
+            else:
+                status.write(f'Reading {len(range_names)} range(s) of spreadsheet {spreadsheet_id}')
+                sheets = self.__sheets_factory()
+                result = _execute_with_backoff(lambda: sheets.values().batchGet(
+                    spreadsheetId=spreadsheet_id, ranges=range_names, majorDimension='ROWS'))
+                # Value ranges come back in the order they were asked for
+                read = {range_name: value_range.get('values', [])
+                        for range_name, value_range in zip(range_names, result.get('valueRanges', []))}
+                if version is not None:
+                    if cached is not None and cached['version'] == version:
+                        read = {**cached['ranges'], **read}
+                    self.__cache[spreadsheet_id] = {'version': version, 'ranges': read}
+                    self.__save()
+                cached = {'version': version, 'ranges': read}
+            for range_name in range_names:
+                values[(spreadsheet_id, range_name)] = copy.deepcopy(
+                    cached['ranges'][range_name])
+        return values
+
+    def __save(self):
+        temp_path = f'{self.__cache_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.__cache, f)
+        os.replace(temp_path, self.__cache_path)
 
 
 class GCloud:
@@ -36,30 +161,36 @@ class GCloud:
         def __init__(self, site: Site):
             self.name = site.name
             self.id = None
-            self.upload_folders: Dict[str, GCloud._UploadFolder] = {}
-            for placard in site.prepared_placards:
-                for name, output_file in placard.output_files.items():
-                    if not name in self.upload_folders:
-                        self.upload_folders[name] = GCloud._UploadFolder(
-                            name, output_file.mime_type)
-                    elif self.upload_folders[name].mime_type != output_file.mime_type:
-                        raise Exception(
-                            f'Mismatched upload folder mime type for {name}.  Both {self.upload_folders[name].mime_type} and {output_file.mime_type} use that name.')
+            self.upload_folders: Dict[str, GCloud._UploadFolder] = {
+                name: GCloud._UploadFolder(name, mime_type) for name, mime_type in site.output_types().items()}
 
     class _UploadFolder(Folder):
         def __init__(self, name: str, mime_type: str):
             super().__init__(name)
             self.mime_type = mime_type
-            self.__file_name_to_hash = {}
-
-        def set_file_hash(self, name, hash):
-            self.__file_name_to_hash[name] = hash
+            self.__lock = threading.Lock()
+            self.__remote_files: Dict[str, GCloud._RemoteFileData] = {}
+            self.__name_locks: Dict[str, threading.Lock] = {}
+
+        def name_lock(self, name) -> threading.Lock:
+            # Held while pushing to name, so that two placards with the same
+            # name (e.g. duplicate sheet rows) never both create a file
+            with self.__lock:
+                if name not in self.__name_locks:
+                    self.__name_locks[name] = threading.Lock()
+                return self.__name_locks[name]
+
+        def set_remote_file(self, remote):
+            with self.__lock:
+                self.__remote_files[remote.name] = remote
+
+        def get_remote_file(self, name):
+            with self.__lock:
+                return self.__remote_files.get(name)
 
         def get_file_hash(self, name):
-            if name in self.__file_name_to_hash:
-                return self.__file_name_to_hash[name]
-            else:
-                return None
+            remote = self.get_remote_file(name)
+            return remote.hash if remote is not None else None
 
     class _RemoteFileData:
         def __init__(self, item):
@@ -72,10 +203,21 @@ class GCloud:
                 return
             self.hash = item['properties']['md5']
 
-    def __init__(self, placard_folder_id: str, sites: List[Site]):
+    def __init__(self, placard_folder_id: str, sites: List[Site], drive=None, sheets=None):
+        """drive and sheets stand in for the Google services (e.g. for a fake
+        Drive).  When not given, each is built from the user's credentials
+        the first time it is needed, so runs that never read the sheet or
+        upload don't pay for either."""
         self.__args = parser.parse_args()
 
-        self.__init_gapi()
+        self.__local = threading.local()
+        self.__creds = None
+        self.__creds_lock = threading.Lock()
+        self.__drive_factory = (lambda: drive) if drive is not None else self.__build_drive
+        self.__sheets = sheets.spreadsheets() if sheets is not None else None
+        self.__drive = None
+        self.__files = None
+        self.__index = None
         self.__placards_folder_id = placard_folder_id
         self.__remote_hashes_loaded = False
         self.__sites = sites
@@ -83,23 +225,80 @@ class GCloud:
         self.__site_folders_loaded = False
         self.__drive_initialized = False
 
-    def __init_gapi(self):
-        creds = None
-        if os.path.exists('token.json'):
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open('token.json', 'w') as token:
-                token.write(creds.to_json())
-
-        self.__files = build('drive', 'v3', credentials=creds).files()
-        self.__sheets = build('sheets', 'v4', credentials=creds).spreadsheets()
+    def __credentials(self):
+        with self.__creds_lock:
+            if self.__creds is not None:
+                return self.__creds
+
+            from google.auth.transport.requests import Request
+            from google.oauth2.credentials import Credentials
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
+            creds = None
+            if os.path.exists('token.json'):
+                creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    creds.refresh(Request())
+                else:
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        'credentials.json', SCOPES)
+                    creds = flow.run_local_server(port=0)
+                # Save the credentials for the next run
+                with open('token.json', 'w') as token:
+                    token.write(creds.to_json())
+            self.__creds = creds
+            return creds
+
+    def __build(self, service: str, version: str):
+        # The discovery documents bundled with the client library are used
+        # rather than fetching them on every run
+        from googleapiclient.discovery import build
+        return build(service, version, credentials=self.__credentials(), static_discovery=True)
+
+    def __build_drive(self):
+        return self.__build('drive', 'v3')
+
+    def __thread_files(self):
+        # Service objects aren't thread-safe, so each upload worker gets its own
+        if not hasattr(self.__local, 'files'):
+            self.__local.files = self.__drive_factory().files()
+        return self.__local.files
+
+    def __sync_index(self):
+        """Brings the local Drive index up to date from the changes feed,
+        starting it over if there is no usable page token."""
+        from googleapiclient.errors import HttpError
+        token = self.__index.page_token(self.__placards_folder_id)
+        if token is not None:
+            try:
+                status.write('Loading Drive changes')
+                self.__apply_changes(token)
+                return
+            except HttpError as e:
+                if e.resp.status not in [400, 404, 410]:
+                    raise
+                status.write('Drive changes token expired, relisting')
+
+        # Take the token before listing anything so that nothing that
+        # happens during the listing is missed.
+        start = _execute_with_backoff(lambda: self.__drive.changes().getStartPageToken(
+            supportsAllDrives=True))
+        self.__index.reset(self.__placards_folder_id, start['startPageToken'])
+
+    def __apply_changes(self, token: str):
+        while True:
+            results = _execute_with_backoff(lambda: self.__drive.changes().list(
+                pageToken=token,
+                spaces='drive',
+                pageSize=1000,
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+                fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, parents, trashed, properties))'))
+            token = results.get('nextPageToken') or results['newStartPageToken']
+            self.__index.apply_changes(results.get('changes', []), token)
+            if 'newStartPageToken' in results:
+                return
 
     def __init_site_folders(self):
         if self.__site_folders_loaded:
@@ -127,40 +326,49 @@ class GCloud:
             for folder in site_folder.upload_folders.values():
                 names = set()
                 status.push(folder.name)
-                nextPageToken = ''
-                page = 1
-                while True:
-                    results = self.__files.list(
-                        q=f"mimeType='{folder.mime_type}' and parents in '{folder.id}' and trashed=false",
-                        spaces='drive',
-                        pageSize=PAGE_SIZE,
-                        includeItemsFromAllDrives=True,
-                        supportsAllDrives=True,
-                        fields="nextPageToken, files(id, name, properties)",
-                        pageToken=nextPageToken).execute()
-                    items = results.get('files', [])
-                    nextPageToken = results.get('nextPageToken')
-                    for item in items:
-                        remote = GCloud._RemoteFileData(item)
-                        if remote.name in names:
-                            raise Exception(
-                                f'Duplicate remote file {folder.name} / {remote.name}')
-                        names.add(remote.name)
-                        status.write(remote.name)
-                        folder.set_file_hash(remote.name, remote.hash)
-                    status.write(f'Loaded page #{page}')
-                    page += 1
-                    if nextPageToken is None:
-                        status.write(f'No more pages.  Loaded {len(names)} file hashes.')
-                        break
+                if not self.__index.is_listed(folder.id):
+                    self.__list_folder(folder)
+                for item in self.__index.folder_files(folder.id, folder.mime_type):
+                    remote = GCloud._RemoteFileData(item)
+                    if remote.name in names:
+                        raise Exception(
+                            f'Duplicate remote file {folder.name} / {remote.name}')
+                    names.add(remote.name)
+                    folder.set_remote_file(remote)
+                status.write(f'Loaded {len(names)} file hashes.')
                 status.pop()
             status.pop()
         status.pop()
 
+    def __list_folder(self, folder: _UploadFolder):
+        items = []
+        nextPageToken = ''
+        page = 1
+        while True:
+            results = _execute_with_backoff(lambda: self.__files.list(
+                q=f"mimeType='{folder.mime_type}' and parents in '{folder.id}' and trashed=false",
+                spaces='drive',
+                pageSize=PAGE_SIZE,
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+                fields="nextPageToken, files(id, name, properties)",
+                pageToken=nextPageToken))
+            items += results.get('files', [])
+            nextPageToken = results.get('nextPageToken')
+            status.write(f'Loaded page #{page}')
+            page += 1
+            if nextPageToken is None:
+                break
+        self.__index.replace_folder_files(folder.id, folder.mime_type, items)
+
     def __get_or_create_folder_id(self, parent_folder_id, folder: Folder):
         if folder.id:
             return folder.id
 
+        folder.id = self.__index.folder_id(parent_folder_id, folder.name)
+        if folder.id:
+            return folder.id
+
         item = self.__find_existing_item(
             parent_folder_id, folder.name, 'application/vnd.google-apps.folder')
         if not item:
@@ -176,6 +384,8 @@ class GCloud:
             folder.id = result.get('id')
         else:
             folder.id = item['id']
+        self.__index.put_folder(parent_folder_id, folder.name, folder.id)
+        return folder.id
 
     def __find_existing_item(self, parent_folder_id: str, item_name: str, mime_type: str):
         results = self.__files.list(
@@ -196,93 +406,169 @@ class GCloud:
         if self.__drive_initialized:
             return
 
+        self.__drive = self.__drive_factory()
+        self.__files = self.__drive.files()
+        self.__index = DriveIndex(os.path.join(
+            os.curdir, 'prepared', 'drive_index.sqlite'))
         try:
             status.push("Preparing Google Drive folder(s)")
+            self.__sync_index()
             self.__init_site_folders()
             self.__load_remote_hashes()
         finally:
             status.pop()
         self.__drive_initialized = True
 
-    def upload(self):
-        self.init_drive()
-
-        status.push('Sync')
+    def upload(self) -> List[UploadResult]:
+        self.start_upload()
         for site in self.__sites:
-            status.push(site.name)
-            site_folder = self.__site_folders[site.name]
             for placard in site.prepared_placards:
-                status.push(placard.name)
-                for output_file in placard.output_files.values():
-                    self._push_to_folder(
-                        site_folder.upload_folders[output_file.type], placard, output_file)
-                    pass
-                status.pop()
+                self.upload_placard(site, placard)
+        return self.finish_upload()
+
+    def start_upload(self):
+        """Starts preparing Drive in the background.  Placards can be queued
+        with upload_placard() right away, they are pushed as soon as Drive is
+        ready."""
+        status.write(
+            f'{len(get_manifest().dirty_placards())} placard(s) changed since their last upload')
+        self.__init_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='drive')
+        self.__drive_ready = self.__init_pool.submit(self.init_drive)
+        self.__upload_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, self.__args.upload_jobs), thread_name_prefix='upload')
+        # Keeps callers from queuing more than this many files ahead of the uploads
+        self.__upload_slots = threading.BoundedSemaphore(
+            max(1, self.__args.upload_jobs) * UPLOAD_QUEUE_PER_JOB)
+        self.__upload_futures = []
+
+    def upload_placard(self, site: Site, placard: PreparedPlacard):
+        """Queues placard's output files for upload.  Blocks while the queue
+        is full."""
+        for output_file in placard.output_files.values():
+            self.__upload_slots.acquire()
+            future = self.__upload_pool.submit(
+                self.__push, site, placard, output_file)
+            future.add_done_callback(lambda _: self.__upload_slots.release())
+            self.__upload_futures.append(future)
+
+    def finish_upload(self) -> List[UploadResult]:
+        """Waits for everything queued to be uploaded and reports on it."""
+        status.push('Sync')
+        try:
+            results = [future.result() for future in self.__upload_futures]
+        finally:
+            self.__upload_pool.shutdown(wait=True)
+            self.__init_pool.shutdown(wait=True)
+            status.pop()
+
+        self.__report(results)
+        return results
+
+    def __push(self, site: Site, placard: PreparedPlacard, output_file: OutputFile) -> UploadResult:
+        self.__drive_ready.result()
+        status.push(site.name)
+        status.push(placard.name)
+        try:
+            return self._push_to_folder(
+                self.__site_folders[site.name].upload_folders[output_file.type], site, placard, output_file)
+        finally:
+            status.pop()
             status.pop()
-        status.pop()
 
-    def _push_to_folder(self, upload_folder: _UploadFolder, placard: PreparedPlacard, output_file: OutputFile):
+    def __report(self, results: List[UploadResult]):
+        counts = {}
+        for result in results:
+            counts[result.action] = counts.get(result.action, 0) + 1
+        print('Sync: ' + ', '.join(f'{count} {action}' for action,
+              count in sorted(counts.items())), end='\033[K\n')
+        failed = [result for result in results if result.action == UploadResult.FAILED]
+        for result in failed:
+            print(f'  Failed {result.site_name} / {result.file_name}: {result.error}')
+        if failed:
+            raise Exception(f'Failed to upload {len(failed)} file(s)')
+
+    def _push_to_folder(self, upload_folder: _UploadFolder, site: Site, placard: PreparedPlacard, output_file: OutputFile) -> UploadResult:
 
         # Create name, do initial change detection
         escaping = str.maketrans({'\\': '\\\\', "'": "\'"})
         file_name = f'{placard.name}{os.path.splitext(output_file.file_path)[1]}'.translate(
             escaping)
+        with upload_folder.name_lock(file_name):
+            return self.__push_file(upload_folder, site, output_file, file_name)
 
-        # Do change detection
+    def __push_file(self, upload_folder: _UploadFolder, site: Site, output_file: OutputFile, file_name: str) -> UploadResult:
+        # Do change detection.  A file created by an earlier push of the
+        # same name is already known here, so it is updated rather than
+        # created again.
         local_hash = output_file.get_hash()
-        remote_hash = upload_folder.get_file_hash(file_name)
+        remote = upload_folder.get_remote_file(file_name)
+        remote_hash = remote.hash if remote is not None else None
         if remote_hash == local_hash:
             status.write(f'No change for {file_name}')
-            return
+            output_file.record_upload(local_hash)
+            return UploadResult(site.name, file_name, UploadResult.UNCHANGED)
         else:
             status.write(f'Change detected for {file_name} - remote: {remote_hash} vs local: {local_hash}')
 
-        # Find existing file (if any)
-        file = self.__find_existing_item(
-            upload_folder.id, file_name, upload_folder.mime_type)
+        def media():
+            from googleapiclient.http import MediaFileUpload
+            return MediaFileUpload(os.path.abspath(output_file.file_path),
+                                   mimetype=upload_folder.mime_type,
+                                   resumable=True)
 
-        # Upload file to this folder
-        media = MediaFileUpload(os.path.abspath(output_file.file_path),
-                                mimetype=upload_folder.mime_type,
-                                resumable=True)
-
-        if file is not None:
-            status.write(f'Updating {file_name}')
-            file_metadata = {
-                'name': file_name,
-                'properties': {
-                    'md5': local_hash
+        files = self.__thread_files()
+        try:
+            if remote is not None:
+                # The remote listing already told us which file to update
+                status.write(f'Updating {file_name}')
+                file_metadata = {
+                    'name': file_name,
+                    'properties': {
+                        'md5': local_hash
+                    }
                 }
-            }
-            self.__files.update(
-                fileId=file['id'],
-                body=file_metadata,
-                media_body=media,
-                supportsAllDrives=True,
-                fields="id").execute()
-        else:
-            status.write(f'Uploading {file_name}')
-            file_metadata = {
-                'name': file_name,
-                'parents': [upload_folder.id],
-                'properties': {
-                    'md5': local_hash
+                file_id = remote.id
+                _execute_with_backoff(lambda: files.update(
+                    fileId=remote.id,
+                    body=file_metadata,
+                    media_body=media(),
+                    supportsAllDrives=True,
+                    fields="id"))
+                action = UploadResult.UPDATED
+            else:
+                status.write(f'Uploading {file_name}')
+                file_metadata = {
+                    'name': file_name,
+                    'parents': [upload_folder.id],
+                    'properties': {
+                        'md5': local_hash
+                    }
                 }
-            }
-            self.__files.create(
-                body=file_metadata,
-                media_body=media,
-                supportsAllDrives=True,
-                fields="id").execute()
-
-    def load_sheet(self, spreadsheet_id, range_name, min_cols):
-        result = self.__sheets.values().get(spreadsheetId=spreadsheet_id,
-                                            range=range_name).execute()
-        values = result.get('values', [])
-        if not values:
-            status.write('No data found.')
-            return []
-        for row in values:
-            while len(row) < min_cols:
-                row.append('')
-        return values
+                file_id = _execute_with_backoff(lambda: files.create(
+                    body=file_metadata,
+                    media_body=media(),
+                    supportsAllDrives=True,
+                    fields="id"))['id']
+                action = UploadResult.CREATED
+        except Exception as e:
+            status.write(f'Failed to upload {file_name}: {e}')
+            return UploadResult(site.name, file_name, UploadResult.FAILED, e)
+
+        upload_folder.set_remote_file(GCloud._RemoteFileData(
+            {'name': file_name, 'id': file_id, 'properties': {'md5': local_hash}}))
+        self.__index.put_file(file_id, upload_folder.id,
+                              file_name, upload_folder.mime_type, local_hash)
+        output_file.record_upload(local_hash)
+        return UploadResult(site.name, file_name, action)
+
+    def __sheets_service(self):
+        if self.__sheets is None:
+            self.__sheets = self.__build('sheets', 'v4').spreadsheets()
+        return self.__sheets
+
+    def sheet_source(self, check_version: bool = True) -> GoogleSheetSource:
+        """Without check_version the spreadsheet is read without asking
+        Drive whether it changed, for runs that don't otherwise use Drive."""
+        return GoogleSheetSource(self.__sheets_service, self.__drive_factory if check_version else None,
+                                 os.path.join(os.curdir, 'prepared', 'sheet_cache.json'))
@@ -0,0 +1,61 @@
+import io
+
+from PIL import Image, ImageOps
+
+
+def normalize_logo(data: bytes, max_width: int, max_height: int) -> bytes:
+    """Decodes a jpeg/webp/png logo and returns it as a compact PNG.
+
+    The image is rotated according to its EXIF orientation, shrunk (never
+    enlarged) to fit within max_width x max_height and written without any
+    metadata, so the same input always produces the same bytes.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        if image.width > max_width or image.height > max_height:
+            image.thumbnail((max_width, max_height), Image.LANCZOS)
+
+        # Drops EXIF, ICC profiles, text chunks, dpi etc.
+        image.info = {}
+        output = io.BytesIO()
+        image.save(output, format='PNG', optimize=True)
+        return output.getvalue()
+
+
+def _exact_palette(image: Image.Image) -> Image.Image:
+    # image (RGB or L) as a palette image with exactly its colors, or None
+    # if it has too many colors for one.  Median cut keeps every color when
+    # there are few enough, but it is checked rather than trusted.
+    if image.getcolors(256) is None:
+        return None
+    reduced = image.convert('RGB').quantize(
+        256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    if reduced.convert(image.mode).tobytes() != image.tobytes():
+        return None
+    return reduced
+
+
+def optimize_png(data: bytes) -> bytes:
+    """Losslessly recompresses a PNG, returning whichever is smaller.
+
+    An alpha channel that is fully opaque is dropped, and images with no
+    more than 256 colors are stored with a palette.  Metadata is dropped
+    and the same pixels always produce the same bytes.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            return data
+        if image.mode == 'RGBA' and image.getextrema()[3] == (255, 255):
+            image = image.convert('RGB')
+        if image.mode != 'RGBA':
+            image = _exact_palette(image) or image
+
+        image.info = {}
+        output = io.BytesIO()
+        image.save(output, format='PNG', optimize=True)
+        optimized = output.getvalue()
+    return optimized if len(optimized) < len(data) else data
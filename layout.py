@@ -0,0 +1,78 @@
+import math
+import re
+from typing import List, Tuple
+
+# Conversion of absolute SVG/CSS lengths to inches
+UNITS_PER_INCH = {
+    'in': 1,
+    'px': 96,
+    'pt': 72,
+    'cm': 2.54,
+    'mm': 25.4,
+}
+
+# Paper sizes known to --multiprint_paper, portrait (width, height) in inches
+PAPER_SIZES = {
+    'letter': (8.5, 11),
+    'legal': (8.5, 14),
+    'tabloid': (11, 17),
+    'a4': (8.27, 11.69),
+    'a3': (11.69, 16.54),
+}
+
+
+def length_in_inches(raw: str) -> float:
+    match = re.match(r'^([0-9]+|[0-9]+\.[0-9]+)(in|px|pt|cm|mm)$', raw.strip())
+    if match is None:
+        raise Exception(f'Not able to interpret {raw} as an absolute length.')
+    return float(match.group(1)) / UNITS_PER_INCH[match.group(2)]
+
+
+class PageLayout:
+    """Where placards of one size go on a sheet of paper.
+
+    All lengths are in inches, and slots are the top left corner of each
+    placard measured from the top left of the paper.
+    """
+
+    def __init__(self, paper_size: Tuple[float, float], placard_size: Tuple[float, float], slots: List[Tuple[float, float]]):
+        self.paper_size = paper_size
+        self.placard_size = placard_size
+        self.slots = slots
+
+    @property
+    def capacity(self) -> int:
+        return len(self.slots)
+
+    def key(self) -> str:
+        """Identifies the layout, e.g. for caching pages laid out with it."""
+        return repr((self.paper_size, self.placard_size, self.slots))
+
+
+def _evenly(available: float, size: float, count: int) -> List[float]:
+    # Offsets of count items of size spread over available with equal space
+    # before, between and after them
+    gap = (available - count * size) / (count + 1)
+    return [gap + i * (size + gap) for i in range(count)]
+
+
+def grid_layout(paper_size: Tuple[float, float], margin: float, placard_size: Tuple[float, float]) -> PageLayout:
+    """Fits as many placards as possible in a grid on the paper, trying it in
+    both portrait and landscape, and spaces them evenly within the margins."""
+    (placard_width, placard_height) = placard_size
+    best = None
+    for (width, height) in [paper_size, tuple(reversed(paper_size))]:
+        (available_width, available_height) = (width - 2 * margin, height - 2 * margin)
+        columns = math.floor(available_width / placard_width)
+        rows = math.floor(available_height / placard_height)
+        if best is not None and columns * rows <= best.capacity:
+            continue
+        slots = [(margin + x, margin + y)
+                 for y in _evenly(available_height, placard_height, rows)
+                 for x in _evenly(available_width, placard_width, columns)]
+        best = PageLayout((width, height), placard_size, slots)
+
+    if best.capacity == 0:
+        raise Exception(
+            f'A {placard_width:.2f}in x {placard_height:.2f}in placard does not fit on {paper_size[0]}in x {paper_size[1]}in paper with {margin}in margins')
+    return best
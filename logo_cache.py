@@ -0,0 +1,214 @@
+import concurrent.futures
+import hashlib
+import json
+import os.path
+import os
+import threading
+import time
+from typing import Dict, List
+
+from utils import status
+
+# Logo types we know how to turn into a PNG, and the extension they are saved with
+CONTENT_TYPES = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+}
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/101.0.4951.64 Safari/537.36'
+
+# (connect, read) timeouts in seconds for a single logo request
+TIMEOUT = (10, 30)
+# Number of logos fetched at once
+FETCH_CONCURRENCY = 8
+# Cached logos are used as-is for this long before being revalidated
+FRESH_SECONDS = 24 * 60 * 60
+# URLs that failed are not retried for this long
+NEGATIVE_SECONDS = 60 * 60
+
+
+class CachedLogo:
+    def __init__(self, url: str, content_type: str, path: str, sha256: str):
+        self.url = url
+        self.content_type = content_type
+        self.path = path
+        # Changes whenever the logo behind url does
+        self.sha256 = sha256
+
+
+class LogoCache:
+    """Content-addressed store of downloaded logos, keyed by URL.
+
+    Logo bytes live in objects/<sha256> so that any number of URLs (and
+    placards) share one copy.  index.json remembers, per URL, which object
+    it resolved to along with its ETag/Last-Modified for revalidation, and
+    which URLs recently failed so that they aren't hammered on every run.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.__objects_dir = os.path.join(cache_dir, 'objects')
+        self.__index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(self.__objects_dir, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__url_locks: Dict[str, threading.Lock] = {}
+        self.__entries = {}
+        self.__failures = {}
+        self.__executor = None
+        self.__session = None
+        self.__load()
+
+    def __get_session(self):
+        # Created on the first download, so that runs where every logo is
+        # cached never import requests
+        with self.__lock:
+            if self.__session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.headers['User-Agent'] = USER_AGENT
+                adapter = HTTPAdapter(pool_connections=FETCH_CONCURRENCY,
+                                      pool_maxsize=FETCH_CONCURRENCY)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.__session = session
+            return self.__session
+
+    def __load(self):
+        if not os.path.isfile(self.__index_path):
+            return
+        with open(self.__index_path, 'r') as f:
+            index = json.load(f)
+        self.__entries = index.get('entries', {})
+        self.__failures = index.get('failures', {})
+
+    def save(self):
+        """Writes the index, first waiting for any background fetches."""
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+        with self.__lock:
+            index = {'entries': self.__entries, 'failures': self.__failures}
+            temp_path = f'{self.__index_path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.replace(temp_path, self.__index_path)
+
+    def prefetch(self, urls: List[str], wait: bool = True):
+        """Fetches (or revalidates) every distinct URL concurrently, in order.
+
+        With wait=False this returns straight away and the logos arrive in the
+        background; get() on a URL that is still being fetched waits for it.
+        """
+        distinct = list(dict.fromkeys(url for url in urls if url))
+        if not wait:
+            with self.__lock:
+                if self.__executor is None:
+                    self.__executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=FETCH_CONCURRENCY, thread_name_prefix='logo')
+            for url in distinct:
+                self.__executor.submit(self.__fetch, url)
+            return
+
+        status.push(f'Fetching {len(distinct)} logos')
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+                list(executor.map(self.__fetch, distinct))
+        finally:
+            status.pop()
+        self.save()
+
+    def get(self, url: str) -> CachedLogo:
+        """Returns the cached logo for url, fetching it first if needed."""
+        self.__fetch(url)
+        with self.__lock:
+            if url in self.__entries:
+                entry = self.__entries[url]
+                return CachedLogo(url, entry['content_type'], self.__object_path(entry['sha256']), entry['sha256'])
+            raise Exception(
+                f'Failed to download {url}: {self.__failures[url]["error"]}')
+
+    def __object_path(self, digest: str) -> str:
+        return os.path.join(self.__objects_dir, digest)
+
+    def __url_lock(self, url: str) -> threading.Lock:
+        with self.__lock:
+            if url not in self.__url_locks:
+                self.__url_locks[url] = threading.Lock()
+            return self.__url_locks[url]
+
+    def __fetch(self, url: str):
+        with self.__url_lock(url):
+            now = time.time()
+            with self.__lock:
+                entry = self.__entries.get(url)
+                failure = self.__failures.get(url)
+            if entry is not None and not os.path.isfile(self.__object_path(entry['sha256'])):
+                entry = None
+            if entry is not None and now - entry['validated'] < FRESH_SECONDS:
+                return
+            if failure is not None and now - failure['failed'] < NEGATIVE_SECONDS:
+                return
+
+            try:
+                entry = self.__download(url, entry)
+            except Exception as e:
+                # A stale copy is still better than no logo at all
+                status.write(f'Failed to download {url}: {e}')
+                with self.__lock:
+                    self.__failures[url] = {'error': str(e), 'failed': now}
+                    if entry is None:
+                        self.__entries.pop(url, None)
+                return
+
+            entry['validated'] = now
+            with self.__lock:
+                self.__entries[url] = entry
+                self.__failures.pop(url, None)
+
+    def __download(self, url: str, entry: dict) -> dict:
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        with self.__get_session().get(url, headers=headers, timeout=TIMEOUT) as response:
+            if response.status_code == 304 and entry is not None:
+                return dict(entry)
+            response.raise_for_status()
+
+            content_type = response.headers.get(
+                'Content-Type', '').split(';')[0].strip()
+            if content_type not in CONTENT_TYPES:
+                raise Exception(
+                    f'Unsupported Content-Type: {content_type} from {url}')
+
+            digest = hashlib.sha256(response.content).hexdigest()
+            object_path = self.__object_path(digest)
+            if not os.path.isfile(object_path):
+                temp_path = f'{object_path}.{threading.get_ident()}.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(response.content)
+                os.replace(temp_path, object_path)
+
+            return {
+                'sha256': digest,
+                'content_type': content_type,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_logo_cache() -> LogoCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LogoCache(os.path.join(
+                os.curdir, 'prepared', 'logo_cache'))
+        return _cache
@@ -0,0 +1,152 @@
+import json
+import os.path
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+-- What each placard was last built from and into.  placard is the placard
+-- dir relative to the prepared dir, name is a blob name or a file path
+-- relative to the placard dir and kind is 'blob', 'file' or 'output'.
+CREATE TABLE IF NOT EXISTS hashes (
+    placard TEXT NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    hash TEXT,
+    PRIMARY KEY (placard, name)
+);
+CREATE INDEX IF NOT EXISTS hashes_by_kind ON hashes (kind, placard);
+-- Hash of each output as it was last uploaded
+CREATE TABLE IF NOT EXISTS uploads (
+    placard TEXT NOT NULL,
+    name TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (placard, name)
+);
+-- Fingerprint of the sheet row (and input files) each placard was last
+-- built from, and enough about its outputs to use them without rebuilding.
+CREATE TABLE IF NOT EXISTS rows (
+    placard TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+'''
+
+_LEGACY_HASH_FILE = 'hashes.md5'
+_LEGACY_BLOBS = ['logo_url', 'data']
+_LEGACY_OUTPUTS = ['placard.svg', 'placard.png', 'placard.pdf']
+
+
+class Manifest:
+    """Single SQLite store of every placard's hashes under the prepared dir.
+
+    Replaces the per-placard hashes.md5 files, which are imported once the
+    first time the manifest is opened.
+    """
+
+    def __init__(self, prepared_dir: str):
+        self.__prepared_dir = prepared_dir
+        os.makedirs(prepared_dir, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(os.path.join(
+            prepared_dir, 'manifest.sqlite'), check_same_thread=False)
+        with self.__lock, self.__db:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.executescript(SCHEMA)
+        self.__migrate()
+
+    def placard_key(self, placard_dir: str) -> str:
+        return os.path.relpath(placard_dir, self.__prepared_dir)
+
+    def load(self, placard: str) -> Dict[str, str]:
+        with self.__lock:
+            rows = self.__db.execute(
+                'SELECT name, hash FROM hashes WHERE placard = ?', (placard,)).fetchall()
+        return {name: hash for (name, hash) in rows}
+
+    def save(self, placard: str, entries: Dict[str, Tuple[str, str]]):
+        """Replaces everything known about placard with entries, which maps
+        name -> (kind, hash)."""
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'DELETE FROM hashes WHERE placard = ?', (placard,))
+            self.__db.executemany(
+                'INSERT INTO hashes (placard, name, kind, hash) VALUES (?, ?, ?, ?)',
+                [(placard, name, kind, hash) for name, (kind, hash) in entries.items()])
+
+    def record_upload(self, placard: str, name: str, hash: str):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO uploads (placard, name, hash) VALUES (?, ?, ?)',
+                (placard, name, hash))
+
+    def load_row(self, placard: str) -> Optional[Tuple[str, dict]]:
+        """The (fingerprint, record) placard was last built with, if any."""
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT fingerprint, record FROM rows WHERE placard = ?', (placard,)).fetchone()
+        if row is None:
+            return None
+        return (row[0], json.loads(row[1]))
+
+    def save_row(self, placard: str, fingerprint: str, record: dict):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO rows (placard, fingerprint, record) VALUES (?, ?, ?)',
+                (placard, fingerprint, json.dumps(record, sort_keys=True)))
+
+    def dirty_placards(self) -> List[str]:
+        """Placards with an output that differs from what was last uploaded."""
+        with self.__lock:
+            rows = self.__db.execute('''
+                SELECT DISTINCT h.placard FROM hashes h
+                LEFT JOIN uploads u ON u.placard = h.placard AND u.name = h.name
+                WHERE h.kind = 'output' AND (u.hash IS NULL OR u.hash != h.hash)
+                ORDER BY h.placard''').fetchall()
+        return [placard for (placard,) in rows]
+
+    def __migrate(self):
+        with self.__lock, self.__db:
+            done = self.__db.execute(
+                "SELECT value FROM meta WHERE key = 'migrated_hash_files'").fetchone()
+            if done is not None:
+                return
+
+            rows = []
+            for dir_path, _, file_names in os.walk(self.__prepared_dir):
+                if _LEGACY_HASH_FILE not in file_names:
+                    continue
+                placard = self.placard_key(dir_path)
+                with open(os.path.join(dir_path, _LEGACY_HASH_FILE), 'r') as f:
+                    for line in f.read().splitlines():
+                        (name, hash) = line.split(':')
+                        if hash == 'None':
+                            hash = None
+                        if name in _LEGACY_BLOBS:
+                            kind = 'blob'
+                        elif name in _LEGACY_OUTPUTS:
+                            kind = 'output'
+                        else:
+                            kind = 'file'
+                        rows.append((placard, name, kind, hash))
+            self.__db.executemany(
+                'INSERT OR REPLACE INTO hashes (placard, name, kind, hash) VALUES (?, ?, ?, ?)', rows)
+            self.__db.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated_hash_files', ?)", (str(len(rows)),))
+
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def get_manifest() -> Manifest:
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = Manifest(os.path.join(os.curdir, 'prepared'))
+        return _manifest
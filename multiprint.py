@@ -1,65 +1,342 @@
 import argparse
+import base64
+import io
 from audioop import mul
 import os.path
 import os
+import re
+import struct
+from hashlib import md5, sha256
 from urllib.parse import urlencode
+from xml.etree import ElementTree
 
 import defusedxml.ElementTree
-from utils import status, syscmd, ArgumentParser
-from typing import List
+from layout import PAPER_SIZES, PageLayout, grid_layout, length_in_inches
+from renderer import get_renderer
+from utils import PDF_CROP_MARGIN, dedupe_pdf_images, file_hashes, status, ArgumentParser
+from typing import List, Tuple
 
+parser = ArgumentParser()
+parser.add_argument('--multiprint_paper', default='letter', choices=sorted(PAPER_SIZES.keys()),
+                    help='Paper size multiprint pages are laid out on')
+parser.add_argument('--multiprint_margin', default=0.4, type=float,
+                    help='Margin (in inches) kept clear on each edge of a multiprint page')
 
-def svg_to_pdf(svg_path, pdf_path):
-    status.write('Converting multiprint page to PDF')
 
-    # Print PDF to file
-    if syscmd(f"google-chrome --headless --print-to-pdf --print-to-pdf-no-header {svg_path}") != 0:
-        raise Exception(f"Failed to convert {svg_path} to PDF")
+SVG_NS = '{http://www.w3.org/2000/svg}'
+XHTML_NS = '{http://www.w3.org/1999/xhtml}'
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
 
-    # Chrome dumps 'output.pdf' and 'screenshot.png' in curdir
-    if syscmd(f'mv output.pdf {pdf_path}') != 0:
-        raise Exception(f'Failed to mv ./output.pdf to {pdf_path}')
+# SVG user units (px) per inch
+PX_PER_INCH = 96
 
-    # Get rid of page SVG
-    os.remove(svg_path)
 
+def _namespace_ids(root, prefix):
+    """Prefixes every id under root, and every reference to one, with prefix."""
+    ids = set(node.get('id') for node in root.iter() if node.get('id'))
 
-def prepare_page(template_svg_path, output_svg_path, svg_paths):
+    def rename_url(match):
+        return f'url(#{prefix}{match.group(1)})' if match.group(1) in ids else match.group(0)
+
+    for node in root.iter():
+        for name, value in node.attrib.items():
+            if name == 'id':
+                node.set(name, f'{prefix}{value}')
+            elif name in (XLINK_HREF, 'href') and value.startswith('#') and value[1:] in ids:
+                node.set(name, f'#{prefix}{value[1:]}')
+            elif 'url(#' in value:
+                node.set(name, re.sub(r'url\(#([^)]+)\)', rename_url, value))
+
+
+def _png_size(data_url):
+    # Width and height live at a fixed offset in the PNG header, so only the
+    # start of the payload needs decoding.
+    (header, _, payload) = data_url.partition(',')
+    if header != 'data:image/png;base64':
+        return None
+    png = base64.b64decode(payload[:32])
+    if png[:8] != b'\x89PNG\r\n\x1a\n':
+        return None
+    return struct.unpack('>II', png[16:24])
+
+
+def _hoist_images(root, defs):
+    """Moves every embedded PNG under root into defs exactly once.
+
+    Each <image> becomes a <use> of a <symbol> that wraps the shared image,
+    which keeps its position, size, preserveAspectRatio, style and id.
+    """
+    images = {}
+    symbols = {}
+    for node in list(root.iter(f'{SVG_NS}image')):
+        href = node.get(XLINK_HREF) or node.get('href')
+        if href is None or not href.startswith('data:'):
+            continue
+        size = _png_size(href)
+        if size is None:
+            continue
+
+        digest = md5(href.encode('utf8')).hexdigest()
+        if digest not in images:
+            images[digest] = f'img-{digest}'
+            image = ElementTree.SubElement(defs, f'{SVG_NS}image')
+            image.set('id', images[digest])
+            image.set('width', str(size[0]))
+            image.set('height', str(size[1]))
+            image.set(XLINK_HREF, href)
+
+        aspect = node.get('preserveAspectRatio', 'xMidYMid meet')
+        if (digest, aspect) not in symbols:
+            symbols[(digest, aspect)] = f'{images[digest]}-{len(symbols)}'
+            symbol = ElementTree.SubElement(defs, f'{SVG_NS}symbol')
+            symbol.set('id', symbols[(digest, aspect)])
+            symbol.set('viewBox', f'0 0 {size[0]} {size[1]}')
+            symbol.set('preserveAspectRatio', aspect)
+            use = ElementTree.SubElement(symbol, f'{SVG_NS}use')
+            use.set(XLINK_HREF, f'#{images[digest]}')
+
+        node.tag = f'{SVG_NS}use'
+        node.attrib.pop('href', None)
+        node.attrib.pop('preserveAspectRatio', None)
+        node.set(XLINK_HREF, f'#{symbols[(digest, aspect)]}')
+
+
+def multiprint_layout(placard_sizes: List[Tuple[float, float]]) -> PageLayout:
+    """Densest grid of placards (sizes in inches) on the --multiprint_paper.
+    Mixed sizes are laid out as if they were all as big as the biggest."""
+    args = parser.parse_args()
+    placard_size = (max(width for (width, _) in placard_sizes),
+                    max(height for (_, height) in placard_sizes))
+    return grid_layout(PAPER_SIZES[args.multiprint_paper], args.multiprint_margin, placard_size)
+
+
+def _svg_size(svg_path) -> Tuple[float, float]:
+    root = defusedxml.ElementTree.parse(svg_path).getroot()
+    return (length_in_inches(root.get('width')), length_in_inches(root.get('height')))
+
+
+def prepare_page(layout: PageLayout, svg_paths, prefix):
+    """Returns an <svg> the size of the paper with a placard in each of the
+    layout's slots, until svg_paths runs out.
+
+    Every id on the page is prefixed with prefix so that any number of pages
+    can share one document.
+    """
     status.write('Preparing multiprint page')
-    # Load SVG multiprint template and roots
-    e = defusedxml.ElementTree.parse(template_svg_path)
-    root = e.getroot()
-    placard_groups = [
-        root.find(f".//*[@id='placard{i}']") for i in range(1, 7)
-    ]
-    for placard_group, svg_path in zip(placard_groups, svg_paths):
-        placard = defusedxml.ElementTree.parse(svg_path)
-        placard_group.append(placard.getroot())
+    (width, height) = layout.paper_size
+    root = ElementTree.Element(f'{SVG_NS}svg')
+    root.set('width', f'{width}in')
+    root.set('height', f'{height}in')
+    root.set('viewBox', f'0 0 {width * PX_PER_INCH:g} {height * PX_PER_INCH:g}')
+    for i, ((x, y), svg_path) in enumerate(zip(layout.slots, svg_paths)):
+        placard_group = ElementTree.SubElement(root, f'{SVG_NS}g')
+        placard_group.set('id', f'placard{i+1}')
+        placard_group.set(
+            'transform', f'translate({x * PX_PER_INCH:.4f} {y * PX_PER_INCH:.4f})')
+        placard = defusedxml.ElementTree.parse(svg_path).getroot()
+        # Every placard uses the same ids, keep them apart
+        _namespace_ids(placard, f'p{i+1}-')
+        placard_group.append(placard)
+    _namespace_ids(root, prefix)
+    return root
+
+
+def _page_style(layout: PageLayout):
+    # Each page is exactly one sheet of paper, the layout takes care of the
+    # margins.
+    (width, height) = layout.paper_size
+    return f"""
+@page {{ size: {width}in {height}in; margin: 0; }}
+svg.page {{ display: block; }}
+svg.page + svg.page {{ break-before: page; }}
+"""
+
+
+def create_multiprint_document(layout: PageLayout, pages: List[List[str]]):
+    """Builds one XHTML document holding every multiprint page (each a list
+    of placard SVGs to lay out), with a page break between pages."""
+    html = ElementTree.Element(f'{XHTML_NS}html')
+    head = ElementTree.SubElement(html, f'{XHTML_NS}head')
+    ElementTree.SubElement(head, f'{XHTML_NS}style').text = _page_style(layout)
+    body = ElementTree.SubElement(html, f'{XHTML_NS}body')
+    body.set('style', 'margin: 0')
+
+    # Images shared by any of the pages are only embedded once, in an
+    # invisible <svg> that every page refers to.
+    shared = ElementTree.SubElement(body, f'{SVG_NS}svg')
+    shared.set('width', '0')
+    shared.set('height', '0')
+    shared.set('style', 'position: absolute')
+    defs = ElementTree.SubElement(shared, f'{SVG_NS}defs')
+
+    for page, svg_paths in enumerate(pages):
+        root = prepare_page(layout, svg_paths, f'page{page+1}-')
+        root.set('class', 'page')
+        body.append(root)
+    _hoist_images(body, defs)
+    return ElementTree.ElementTree(html)
 
-    e.write(output_svg_path)
+
+def _page_key(layout: PageLayout, svg_paths: List[str]):
+    # A page is determined by the layout and which placards are on it, in
+    # order
+    digest = sha256(layout.key().encode('utf8'))
+    for svg_path in svg_paths:
+        digest.update(file_hashes.hash(svg_path).encode('utf8'))
+    return digest.hexdigest()
+
+
+def _render_pages(out_dir, layout: PageLayout, pages: List[List[str]], page_pdf_paths: List[str]):
+    """Prints pages from a single load of one document, then splits the
+    result into a PDF per page."""
+    document_path = os.path.join(out_dir, 'multiprint.xhtml')
+    create_multiprint_document(layout, pages).write(
+        document_path, encoding='utf-8', xml_declaration=True)
+    try:
+        status.write(f'Printing {len(pages)} multiprint page(s)')
+        (_, pdf_data) = get_renderer().render_bytes(
+            document_path, pdf=True, pdf_options={'preferCSSPageSize': True})
+    finally:
+        os.remove(document_path)
+
+    from PyPDF2 import PdfReader, PdfWriter
+    reader = PdfReader(io.BytesIO(pdf_data))
+    if len(reader.pages) != len(pages):
+        raise Exception(
+            f'Expected {len(pages)} multiprint page(s), Chrome printed {len(reader.pages)}')
+    for page, page_pdf_path in zip(reader.pages, page_pdf_paths):
+        writer = PdfWriter()
+        writer.add_page(page)
+        writer.add_metadata({'/Producer': ''})
+        temp_path = f'{page_pdf_path}.tmp'
+        with open(temp_path, 'wb') as f:
+            writer.write(f)
+        os.replace(temp_path, page_pdf_path)
 
 
 def create_multiprint_pdf(svg_paths: List[str]):
+    from PyPDF2 import PdfReader, PdfWriter
     out_dir = os.path.join(os.curdir, 'prepared/multiprint')
-    os.makedirs(out_dir, exist_ok=True)
-    template_svg_path = os.path.join(os.curdir, 'templates/multiprint_template.svg')
-    page_svg_paths = []
-    page_pdf_paths = []
+    pages_dir = os.path.join(out_dir, 'pages')
+    os.makedirs(pages_dir, exist_ok=True)
     svg_paths_list = list(svg_paths)
     svg_paths_list.sort()
-    i = 0
+    layout = multiprint_layout([_svg_size(svg_path) for svg_path in svg_paths_list])
+
+    # Pages are cached by content, so only pages whose placards changed (or
+    # moved) since they were last printed are rendered again
     status.push('Preparing Multiprint PDF')
-    while i < len(svg_paths_list):
-        page = int(i/6)
-        page_svg_paths.append(os.path.join(out_dir, f'page_{page+1}.svg'))
-        page_pdf_paths.append(os.path.join(out_dir, f'page_{page+1}.pdf'))
-        prepare_page(template_svg_path, page_svg_paths[page], svg_paths_list[i:i+6])
-        svg_to_pdf(page_svg_paths[page], page_pdf_paths[page])
-        i += 6
+    status.write(f'{layout.capacity} placard(s) per page')
+    pages = [svg_paths_list[i:i+layout.capacity]
+             for i in range(0, len(svg_paths_list), layout.capacity)]
+    page_pdf_paths = [os.path.join(pages_dir, f'{_page_key(layout, page)}.pdf')
+                      for page in pages]
+    missing = {}
+    for page, page_pdf_path in zip(pages, page_pdf_paths):
+        if not os.path.isfile(page_pdf_path):
+            missing[page_pdf_path] = page
+    status.write(f'{len(pages) - len(missing)} of {len(pages)} page(s) cached')
+    if missing:
+        _render_pages(out_dir, layout,
+                      list(missing.values()), list(missing.keys()))
+
+    # Assemble the document from the cached pages
+    writer = PdfWriter()
+    for page_pdf_path in page_pdf_paths:
+        writer.add_page(PdfReader(page_pdf_path).pages[0])
+    dedupe_pdf_images(writer.pages)
+    writer.add_metadata({'/Producer': ''})
+    multiprint_pdf_path = os.path.join(out_dir, 'multiprint.pdf')
+    with open(multiprint_pdf_path, 'wb') as f:
+        writer.write(f)
+    _prune_pages(pages_dir, page_pdf_paths)
+    status.pop()
+    return multiprint_pdf_path
+
+
+def _prune_pages(pages_dir: str, page_pdf_paths: List[str]):
+    # Only the pages of the latest document are kept, the rest would
+    # otherwise pile up as placards change
+    keep = {os.path.basename(page_pdf_path) for page_pdf_path in page_pdf_paths}
+    removed = 0
+    for name in os.listdir(pages_dir):
+        if name not in keep:
+            os.remove(os.path.join(pages_dir, name))
+            removed += 1
+    if removed:
+        status.write(f'Removed {removed} unused page(s)')
+
+
+def _page_as_form(writer, page, margin):
+    """Adds page to writer (a PdfWriter) as a form XObject clipped to its
+    MediaBox less margin, returning (reference, width, height) of the
+    clipped area."""
+    from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject
+    box = page.mediabox
+    (left, bottom) = (float(box.left) + margin, float(box.bottom) + margin)
+    (right, top) = (float(box.right) - margin, float(box.top) - margin)
+
+    contents = page.get_contents()
+    form = DecodedStreamObject()
+    form.set_data(contents.get_data() if contents is not None else b'')
+    form = form.flate_encode()
+    form.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Form'),
+        NameObject('/BBox'): ArrayObject([FloatObject(f'{v:.4f}') for v in [left, bottom, right, top]]),
+        NameObject('/Resources'): page.get('/Resources', DictionaryObject()),
+        # Lets the form be placed by its lower left corner
+        NameObject('/Matrix'): ArrayObject([FloatObject(f'{v:.4f}') for v in [1, 0, 0, 1, -left, -bottom]]),
+    })
+    return (writer._add_object(form), right - left, top - bottom)
+
+
+def create_imposed_pdf(pdf_paths: List[str]):
+    """Multiprint without rendering: places each placard's existing PDF
+    in the slots of the multiprint layout.
+    """
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+    out_dir = os.path.join(os.curdir, 'prepared/multiprint')
+    os.makedirs(out_dir, exist_ok=True)
+    pdf_paths_list = list(pdf_paths)
+    pdf_paths_list.sort()
+
+    status.push('Imposing Multiprint PDF')
+    writer = PdfWriter()
+    forms = []
+    for pdf_path in pdf_paths_list:
+        forms.append(_page_as_form(
+            writer, PdfReader(pdf_path).pages[0], PDF_CROP_MARGIN))
+    layout = multiprint_layout(
+        [(width / 72, height / 72) for (_, width, height) in forms])
+    status.write(f'{layout.capacity} placard(s) per page')
+
+    (page_width, page_height) = (layout.paper_size[0] * 72, layout.paper_size[1] * 72)
+    for i in range(0, len(forms), layout.capacity):
+        page = writer.add_blank_page(page_width, page_height)
+        resources = DictionaryObject()
+        content = []
+        for n, ((form, _, height), (x, y)) in enumerate(zip(forms[i:i+layout.capacity], layout.slots)):
+            name = f'/Placard{n+1}'
+            resources[NameObject(name)] = form
+            # PDF is y-up, the layout's slots are from the top
+            tx = x * 72
+            ty = page_height - y * 72 - height
+            content.append(f'q 1 0 0 1 {tx:.4f} {ty:.4f} cm {name} Do Q')
+
+        page[NameObject('/Resources')] = DictionaryObject(
+            {NameObject('/XObject'): resources})
+        stream = DecodedStreamObject()
+        stream.set_data('\n'.join(content).encode('ascii'))
+        page[NameObject('/Contents')] = writer._add_object(stream.flate_encode())
+    # Placards share the ABV band images, which only need to be in the
+    # document once
+    dedupe_pdf_images(writer.pages)
     status.pop()
 
-    # Combine PDF pages.
     multiprint_pdf_path = os.path.join(out_dir, 'multiprint.pdf')
-    syscmd(f'qpdf --empty --pages {" ".join(page_pdf_paths)} -- {multiprint_pdf_path}')
-    for page_pdf in page_pdf_paths: os.remove(page_pdf)
-    return multiprint_pdf_path
\ No newline at end of file
+    writer.add_metadata({'/Producer': ''})
+    with open(multiprint_pdf_path, 'wb') as f:
+        writer.write(f)
+    return multiprint_pdf_path
@@ -0,0 +1,116 @@
+import io
+import math
+import os.path
+import re
+import zlib
+
+from PIL import Image
+
+from renderer import Renderer
+from utils import status
+
+# Resolution the placard is rasterized at for its PDF
+PDF_DPI = 600
+
+# CSS pixels per unit, for the absolute lengths resvg doesn't take as an SVG's
+# size
+_PX_PER_UNIT = {'in': 96, 'pt': 96 / 72, 'cm': 96 / 2.54, 'mm': 96 / 25.4, 'pc': 16}
+
+
+def _px_length(match):
+    (name, number, unit) = match.groups()
+    return f'{name}="{float(number) * _PX_PER_UNIT[unit]:.4f}"'
+
+
+def _with_px_size(svg: str) -> str:
+    """svg with the width and height of its root element in pixels."""
+    root = re.search(r'<(?:\w+:)?svg\b[^>]*>', svg)
+    if root is None:
+        raise Exception('Not able to find the root svg element.')
+    start = re.sub(r'\b(width|height)="\s*([0-9.]+)\s*(in|pt|cm|mm|pc)\s*"', _px_length, root.group(0))
+    return svg[:root.start()] + start + svg[root.end():]
+
+
+def _raster_pdf(image: Image.Image, width: float, height: float) -> bytes:
+    """A single width x height point page showing image, Flate compressed so
+    that the raster stays lossless."""
+    from PyPDF2 import PdfWriter
+    from PyPDF2.generic import DecodedStreamObject, DictionaryObject, EncodedStreamObject, NameObject, NumberObject
+
+    writer = PdfWriter()
+    page = writer.add_blank_page(width, height)
+    pixels = EncodedStreamObject()
+    pixels._data = zlib.compress(image.tobytes(), 9)
+    pixels.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Image'),
+        NameObject('/Width'): NumberObject(image.width),
+        NameObject('/Height'): NumberObject(image.height),
+        NameObject('/ColorSpace'): NameObject('/DeviceRGB'),
+        NameObject('/BitsPerComponent'): NumberObject(8),
+        NameObject('/Filter'): NameObject('/FlateDecode'),
+    })
+    page[NameObject('/Resources')] = DictionaryObject({
+        NameObject('/XObject'): DictionaryObject({NameObject('/Raster'): writer._add_object(pixels)})})
+    content = DecodedStreamObject()
+    content.set_data(f'q {width:.4f} 0 0 {height:.4f} 0 0 cm /Raster Do Q'.encode('ascii'))
+    page[NameObject('/Contents')] = writer._add_object(content.flate_encode())
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+class NativeRenderer(Renderer):
+    """Renders placard SVGs in-process with resvg, without a browser.
+
+    resvg handles everything the placard template uses (text, data URL
+    images, the ABV blur and display:none), but it doesn't fetch web fonts,
+    so the template's fonts have to be installed or be in font_dir.  PDFs
+    are a lossless PDF_DPI raster of the placard on a page of the requested
+    size.  Only SVG is supported, not the multiprint document (see
+    --multiprint_impose).
+    """
+    name = 'native'
+
+    def __init__(self, font_dir: str = None):
+        try:
+            import resvg_py
+        except ImportError as e:
+            raise Exception(
+                'The native renderer needs resvg.  Do you have resvg-py installed?') from e
+        self.__resvg = resvg_py
+        self.__font_dirs = [font_dir] if font_dir is not None else None
+
+    def __rasterize(self, svg_path: str, width: int = None) -> Image.Image:
+        # At its own size (in CSS pixels, like Chrome) unless scaled to width
+        with open(svg_path, 'r', encoding='utf-8') as f:
+            svg = _with_px_size(f.read())
+        data = self.__resvg.svg_to_bytes(
+            svg_string=svg, resources_dir=os.path.dirname(os.path.abspath(svg_path)),
+            width=width, background='white', font_dirs=self.__font_dirs)
+        return Image.open(io.BytesIO(bytes(data))).convert('RGB')
+
+    def render_bytes(self, svg_path: str, window_size: int = None, pdf: bool = False, pdf_options: dict = None):
+        if not svg_path.endswith('.svg'):
+            raise Exception(
+                f'The native renderer only renders SVG, not {svg_path}')
+        with status.span('Rendering', svg=svg_path, png=window_size is not None, pdf=pdf):
+            png_data = None
+            pdf_data = None
+            if window_size is not None:
+                # Like a screenshot of a window_size viewport with the SVG in
+                # its top left corner
+                window = Image.new('RGB', (window_size, window_size), 'white')
+                window.paste(self.__rasterize(svg_path), (0, 0))
+                output = io.BytesIO()
+                window.save(output, format='PNG')
+                png_data = output.getvalue()
+            if pdf:
+                options = pdf_options or {}
+                if options.get('preferCSSPageSize'):
+                    raise Exception('The native renderer has no CSS page size to print to')
+                (paper_width, paper_height) = (options.get('paperWidth', 8.5), options.get('paperHeight', 11))
+                page = Image.new('RGB', (math.ceil(paper_width * PDF_DPI), math.ceil(paper_height * PDF_DPI)), 'white')
+                page.paste(self.__rasterize(svg_path, page.width), (0, 0))
+                pdf_data = _raster_pdf(page, paper_width * 72, paper_height * 72)
+            return (png_data, pdf_data)
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import commands
+import concurrent.futures
 import gcloud_helper
 import os.path
 import os
 import square_template
 import re
-from multiprint import create_multiprint_pdf
-from utils import Hashes, make_hash_stable_pdf, status, ArgumentParser, syscmd, Site, PreparedPlacard
+from logo_cache import get_logo_cache
+from multiprint import create_imposed_pdf, create_multiprint_pdf
+from render_store import get_render_store
+from sheet_source import SnapshotSheetSource, pad_rows, write_snapshot
+from utils import Hashes, file_hashes, output_savings, status, ArgumentParser, Site, PreparedPlacard
 
 __placard_spreadsheet_id = '1jbha_NezYs8ONoTb29U4vIjH7LUzEJQauYeaf-Te93o'
 __placard_spreadsheet_range = 'Placards!A2:H'
@@ -17,14 +23,28 @@ __drive_root_folder_id = '1syThtSUpFmP6vQ_erMh3BDGztN4qPEhD'
 
 
 class GoldPan(Site):
+    SCALE = 0.82
+
     def __init__(self, prepared_dir):
         super().__init__('Gold Pan', prepared_dir)
 
     def _do_prepare_placard(self, brewer: str, beer: str, style: str, abv_str: str, logo_url: str, brewery_font_size: str, beer_font_size: str, style_font_size: str) -> PreparedPlacard:
-        placard_dir = os.path.join(
-            self.site_dir, self._safe_path(f'{brewer}_{beer}'))
+        placard_dir = self.placard_dir(brewer, beer)
         os.makedirs(placard_dir, exist_ok=True)
-        return square_template.prepare_template(placard_dir, brewer, beer, style, abv_str, logo_url, brewery_font_size, beer_font_size, style_font_size, 0.82)
+        return square_template.prepare_template(placard_dir, brewer, beer, style, abv_str, logo_url, brewery_font_size, beer_font_size, style_font_size, GoldPan.SCALE)
+
+    def output_types(self):
+        return square_template.OUTPUT_TYPES
+
+    def _fingerprint_inputs(self, placard_dir: str):
+        return square_template.fingerprint_inputs(placard_dir, GoldPan.SCALE)
+
+
+def _write_trace(trace_path):
+    status.clear()
+    status.write_trace(trace_path)
+    print(status.trace_summary())
+    print(f'Trace written to {trace_path}')
 
 
 def main():
@@ -38,18 +58,27 @@ def main():
     parser.add_argument('--drive_root_folder_id', default=__drive_root_folder_id,
                         help='Id of Google Drive folder used as Placards master folder')
     parser.add_argument('--multiprint', default=False,
-                        action=argparse.BooleanOptionalAction, help='Print all placards marked as "Print" in --multiprint_sheet_id, 6 per page')
+                        action=argparse.BooleanOptionalAction, help='Print all placards marked as "Print" in --multiprint_sheet_id, as many per page as fit')
     parser.add_argument('--multiprint_all', default=False,
-                        action=argparse.BooleanOptionalAction, help='Print all placards, 6 per page')
+                        action=argparse.BooleanOptionalAction, help='Print all placards, as many per page as fit')
+    parser.add_argument('--multiprint_impose', default=False,
+                        action=argparse.BooleanOptionalAction, help='Build the multiprint PDF from each placard\'s existing PDF instead of rendering it')
     parser.add_argument('--multiprint_sheet_id', default=__multiprint_sheet_id,
                         help='Tab and range of Google Sheet to select beers to multiprint')
     parser.add_argument('--multiprint_sheet_range', default=__multiprint_sheet_range,
                         help='Tab and range of Google Sheet to select beers to multiprint')
+    parser.add_argument('--sheet_snapshot', default=None,
+                        help='Read the spreadsheet from this local snapshot (a JSON file written by --save_sheet_snapshot, or a directory of <tab>.csv exports) instead of Google Sheets')
+    parser.add_argument('--save_sheet_snapshot', default=None,
+                        help='Write the spreadsheet ranges that were read to this JSON file, for use with --sheet_snapshot')
     parser.add_argument('--site', default=None,
                         help='Only do work for the given site')
     args = parser.parse_args()
 
     status.debug(args.debug)
+    if args.trace is not None:
+        status.trace()
+        atexit.register(_write_trace, args.trace)
 
     if args.multiprint and args.site is None:
         print('Must specify --site when using --multiprint')
@@ -57,6 +86,7 @@ def main():
 
     prepared_dir = os.path.join(os.curdir, 'prepared')
     os.makedirs(prepared_dir, exist_ok=True)
+    file_hashes.load(os.path.join(prepared_dir, 'file_hashes.json'))
 
     all_sites = [GoldPan(prepared_dir)]
     sites = list(
@@ -64,49 +94,123 @@ def main():
 
     gcloud = gcloud_helper.GCloud(args.drive_root_folder_id, sites)
 
+    # Every range needed is read up front, in as few requests as possible.
+    # Only runs that upload (and so use Drive anyway) ask Drive whether the
+    # spreadsheet changed since it was last read.
+    sheet_source = SnapshotSheetSource(
+        args.sheet_snapshot) if args.sheet_snapshot is not None else gcloud.sheet_source(args.upload)
+    placard_range = (args.placard_sheet_id, args.placard_sheet_range)
+    multiprint_range = (args.multiprint_sheet_id, args.multiprint_sheet_range)
+    sheet_values = sheet_source.read(
+        [placard_range, multiprint_range] if args.multiprint else [placard_range])
+    if args.save_sheet_snapshot is not None:
+        write_snapshot(args.save_sheet_snapshot, sheet_values)
+        status.write(f'Wrote spreadsheet snapshot {args.save_sheet_snapshot}')
+
     multiprint_outputs = set()
     multiprint_selected = []
     if args.multiprint:
         multiprint_selected = [
-            row[0] == 'TRUE' for row in gcloud.load_sheet(
-                args.multiprint_sheet_id, args.multiprint_sheet_range, 1)]
-
-    status.push("Preparing placards")
-    beer_index = 0
-
-    for row in gcloud.load_sheet(args.placard_sheet_id, args.placard_sheet_range, 8):
-        (brewer, beer, style, abv_str, logo_url, brewery_font_size, beer_font_size, style_font_size) = row
+            row[0] == 'TRUE' for row in pad_rows(sheet_values[multiprint_range], 1)]
+
+    # Work out which (row, site) pairs need preparing up front so that the
+    # results can be recorded in sheet order no matter when they finish.
+    # Rows that haven't changed since they were last built are restored
+    # as-is and never reach the template.  A row repeating an earlier row's
+    # brewer and beer would build into the same directory, so it is a
+    # duplicate of (and uses the placard of) that first task.
+    tasks = []
+    first_tasks = {}
+    for beer_index, row in enumerate(pad_rows(sheet_values[placard_range], 8)):
+        beer = row[1]
         if args.beer is not None and args.beer != beer:
-            beer_index += 1
             continue
-
-        status.push(f'{brewer} - {beer}')
         for site in sites:
             if args.site is not None and args.site != site.name:
                 continue
+            placard_dir = site.placard_dir(row[0], row[1])
+            if placard_dir in first_tasks:
+                status.write(f'Row {beer_index + 2} repeats {row[0]} - {row[1]}, using the first one')
+                tasks.append((beer_index, site, row, None, first_tasks[placard_dir]))
+                continue
+            first_tasks[placard_dir] = len(tasks)
+            restored = None if args.force else site.restore_placard(row)
+            tasks.append((beer_index, site, row, restored, None))
+    dirty = [task for task in tasks if task[3] is None and task[4] is None]
+    status.write(f'{len(first_tasks) - len(dirty)} placard(s) unchanged, {len(dirty)} to prepare')
+
+    # Everything below overlaps: logos are fetched in sheet order in the
+    # background, Drive is prepared while the first placards render, and each
+    # placard is uploaded as soon as it is ready.
+    get_logo_cache().prefetch([row[4] for (_, _, row, _, _) in dirty], wait=False)
+    if args.upload:
+        gcloud.start_upload()
 
-            status.push(site.name)
-            prepared_placard = site.prepare_placard(
+    def prepare(task):
+        (_, site, row, _, _) = task
+        (brewer, beer, style, abv_str, logo_url, brewery_font_size, beer_font_size, style_font_size) = row
+        status.push(f'{brewer} - {beer}')
+        status.push(site.name, placard=f'{brewer} - {beer}', site=site.name)
+        try:
+            placard = site.build_placard(
                 brewer, beer, style, abv_str, logo_url, brewery_font_size, beer_font_size, style_font_size)
+            site.record_placard(row, placard)
+            if args.upload:
+                gcloud.upload_placard(site, placard)
+            return placard
+        finally:
+            status.pop()
+            status.pop()
+
+    status.push("Preparing placards")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs))
+    try:
+        futures = [executor.submit(prepare, task) if task[3] is None and task[4] is None else None
+                   for task in tasks]
+        prepared_placards = []
+        for (beer_index, site, row, restored, first_task), future in zip(tasks, futures):
+            if first_task is not None:
+                prepared_placard = prepared_placards[first_task]
+            elif future is None:
+                prepared_placard = restored
+                if args.upload:
+                    gcloud.upload_placard(site, prepared_placard)
+            else:
+                prepared_placard = future.result()
+            prepared_placards.append(prepared_placard)
+            if first_task is None:
+                site.prepared_placards.append(prepared_placard)
             # Add to multiprint, if necessary
             if args.multiprint and args.site == site.name and (multiprint_selected[beer_index] or args.multiprint_all):
-                status.write(f"multiprinting {beer}" )
+                status.write(f"multiprinting {row[1]}")
                 multiprint_outputs.add(prepared_placard)
-            status.pop()
-
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        get_logo_cache().save()
+        file_hashes.save()
+        # Renders replaced by this run's are no longer linked to by anything
+        get_render_store().prune()
         status.pop()
-        beer_index += 1
-
-    status.pop()
+        if args.upload:
+            # Placards that were finished get uploaded even if a later one failed
+            gcloud.finish_upload()
 
-    if args.upload:
-        gcloud.upload()
+    savings = output_savings.summary()
+    if savings is not None:
+        status.clear()
+        print(savings)
 
     if (args.multiprint and len(multiprint_outputs) > 0):
-        # Call multiprint
-        multiprint_pdf_path = create_multiprint_pdf(
-            [output.output_files['SVG'].file_path for output in multiprint_outputs])
-        syscmd(f'google-chrome {multiprint_pdf_path}')
+        # Call multiprint.  The native renderer can't lay out the multiprint
+        # document, so its placards are always imposed.
+        if args.multiprint_impose or args.renderer == 'native':
+            multiprint_pdf_path = create_imposed_pdf(
+                [output.output_files['PDF'].file_path for output in multiprint_outputs])
+        else:
+            multiprint_pdf_path = create_multiprint_pdf(
+                [output.output_files['SVG'].file_path for output in multiprint_outputs])
+        # Open it for printing, without waiting for the browser to close
+        commands.start([args.chrome, multiprint_pdf_path])
 
 
 if __name__ == '__main__':
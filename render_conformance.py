@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os.path
+import os
+import shutil
+import sys
+import tempfile
+
+from PIL import Image, ImageChops, ImageDraw
+from PyPDF2 import PdfReader
+
+from utils import ArgumentParser
+
+# (name, ABV) of a placard in each ABV band of the template
+VARIANTS = [('normal', '4.8'), ('strong', '7.2'), ('boozy', '11.5')]
+
+parser = ArgumentParser()
+parser.add_argument('--conformance_dir', default=None,
+                    help='Directory to render in and keep the outputs and diff images in (defaults to a temporary one that is removed afterwards)')
+parser.add_argument('--conformance_threshold', default=48, type=int,
+                    help='Difference (0-255, in any channel) above which a pixel counts as different')
+parser.add_argument('--conformance_tolerance', default=0.01, type=float,
+                    help='Fraction of pixels of a placard PNG allowed to be different')
+
+
+def make_logo(path):
+    # Transparent, with hard edges and a gradient, like a typical logo
+    image = Image.new('RGBA', (600, 400), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 600, 4):
+        draw.line([(x, 0), (x, 80)], fill=(x * 255 // 600, 60, 140, 255), width=4)
+    draw.ellipse([150, 100, 450, 390], fill=(200, 30, 30, 255), outline=(0, 0, 0, 255), width=12)
+    image.save(path, format='PNG')
+
+
+def _png_difference(expected_path, actual_path, diff_path, threshold):
+    with Image.open(expected_path) as expected, Image.open(actual_path) as actual:
+        (expected, actual) = (expected.convert('RGB'), actual.convert('RGB'))
+        if expected.size != actual.size:
+            return (1.0, f'size {actual.size} instead of {expected.size}')
+        (red, green, blue) = ImageChops.difference(expected, actual).split()
+        largest = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+        mask = largest.point(lambda v: 255 if v > threshold else 0)
+        different = mask.histogram()[255]
+        mask.save(diff_path)
+        return (different / (expected.size[0] * expected.size[1]), '')
+
+
+def _pdf_size(pdf_path):
+    box = PdfReader(pdf_path).pages[0].mediabox
+    return (float(box.width), float(box.height))
+
+
+def build(renderer, work_dir, logo_path):
+    """Builds every variant, with and without a logo, with renderer and
+    returns {variant: placard}."""
+    from placard import GoldPan
+    from renderer import set_renderer
+    from square_template import prepare_template
+
+    set_renderer(renderer)
+    placards = {}
+    for (band, abv) in VARIANTS:
+        for with_logo in [False, True]:
+            variant = f'{band}_logo' if with_logo else band
+            placard_dir = os.path.join(work_dir, renderer.name, variant)
+            os.makedirs(placard_dir, exist_ok=True)
+            if with_logo:
+                shutil.copyfile(logo_path, os.path.join(placard_dir, 'custom.png'))
+            placards[variant] = prepare_template(
+                placard_dir, 'Conformance Brewing', f'The {band.title()} One', 'Hazy IPA', abv,
+                '', '', '', '', GoldPan.SCALE)
+    return placards
+
+
+def main():
+    args = parser.parse_args()
+    from native_renderer import NativeRenderer
+    from renderer import RenderPool
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = os.path.abspath(args.conformance_dir or tempfile.mkdtemp(prefix='placgen-conformance-'))
+    failures = 0
+    try:
+        os.makedirs(work_dir, exist_ok=True)
+        shutil.rmtree(os.path.join(work_dir, 'templates'), ignore_errors=True)
+        shutil.copytree(os.path.join(repo_dir, 'templates'), os.path.join(work_dir, 'templates'))
+        os.chdir(work_dir)
+        logo_path = os.path.join(work_dir, 'logo.png')
+        make_logo(logo_path)
+
+        chrome = RenderPool(args.chrome, 1)
+        try:
+            expected = build(chrome, work_dir, logo_path)
+        finally:
+            chrome.close()
+        actual = build(NativeRenderer(args.font_dir), work_dir, logo_path)
+
+        print(f'{"variant":<14} {"different":>10}  result')
+        for variant, placard in expected.items():
+            native = actual[variant]
+            diff_path = os.path.join(work_dir, f'diff_{variant}.png')
+            (different, problem) = _png_difference(
+                placard.output_files['PNG'].file_path, native.output_files['PNG'].file_path,
+                diff_path, args.conformance_threshold)
+            (expected_size, actual_size) = (_pdf_size(placard.output_files['PDF'].file_path),
+                                            _pdf_size(native.output_files['PDF'].file_path))
+            if not problem and max(abs(e - a) for e, a in zip(expected_size, actual_size)) > 0.5:
+                problem = f'PDF page {actual_size} instead of {expected_size}'
+            if not problem and different > args.conformance_tolerance:
+                problem = f'more than {args.conformance_tolerance:.1%} of pixels differ'
+            failures += 1 if problem else 0
+            print(f'{variant:<14} {different:>10.2%}  {problem or "ok"}')
+        if args.conformance_dir is not None:
+            print(f'Outputs and diff images are in {work_dir}')
+    finally:
+        if args.conformance_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
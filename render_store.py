@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os.path
+import os
+import shutil
+import threading
+from typing import Callable, Dict
+
+from utils import status
+
+
+def render_key(source: bytes, params: dict) -> str:
+    """Content address of rendering source with params (window size, PDF
+    options, ...), which must be JSON serializable."""
+    digest = hashlib.sha256(source)
+    digest.update(json.dumps(params, sort_keys=True).encode('utf8'))
+    return digest.hexdigest()
+
+
+class RenderStore:
+    """Content-addressed store of rendered artifacts.
+
+    Each entry is a directory of files named by the caller, keyed by
+    render_key().  Outputs are hardlinked (or copied, across filesystems)
+    out of the store, so placards on any number of sites that produce the
+    same SVG are only rendered once.  Since outputs may share an inode with
+    the store they must be replaced, never rewritten in place.
+
+    An entry nothing links to any more (e.g. the last render of a placard
+    that has since changed) is removed by prune().
+    """
+
+    def __init__(self, store_dir: str):
+        self.__store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__key_locks: Dict[str, threading.Lock] = {}
+        # Set once an output had to be copied, which makes link counts
+        # meaningless
+        self.__copied = False
+
+    def __key_lock(self, key: str) -> threading.Lock:
+        with self.__lock:
+            if key not in self.__key_locks:
+                self.__key_locks[key] = threading.Lock()
+            return self.__key_locks[key]
+
+    def __entry_dir(self, key: str) -> str:
+        return os.path.join(self.__store_dir, key[:2], key)
+
+    def materialize(self, key: str, outputs: Dict[str, str], render: Callable[[Dict[str, str]], None]):
+        """Places the files stored under key at outputs (name -> path).
+
+        If key isn't stored yet, render is called with name -> path of where
+        to write each file and the result is stored first.
+        """
+        entry_dir = self.__entry_dir(key)
+        with self.__key_lock(key):
+            if not all(os.path.isfile(os.path.join(entry_dir, name)) for name in outputs):
+                temp_dir = f'{entry_dir}.{threading.get_ident()}.tmp'
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                os.makedirs(temp_dir)
+                try:
+                    render({name: os.path.join(temp_dir, name)
+                           for name in outputs})
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    os.replace(temp_dir, entry_dir)
+                finally:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+            else:
+                status.write('Reusing identical render')
+
+            for name, output_path in outputs.items():
+                if not _link_or_copy(os.path.join(entry_dir, name), output_path):
+                    self.__copied = True
+
+    def prune(self):
+        """Removes the entries whose files are no longer linked to from any
+        output.  Must not run while anything is being materialized."""
+        if self.__copied:
+            return
+        removed = 0
+        for prefix in os.listdir(self.__store_dir):
+            prefix_dir = os.path.join(self.__store_dir, prefix)
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                if all(os.stat(os.path.join(entry_dir, name)).st_nlink == 1 for name in os.listdir(entry_dir)):
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    removed += 1
+        if removed:
+            status.write(f'Removed {removed} unused render(s)')
+
+
+def _link_or_copy(source_path: str, output_path: str) -> bool:
+    """Returns whether output_path is a link to source_path, rather than a
+    copy."""
+    # Replacing a file with another link to it is a no-op that would leave
+    # the temporary link behind
+    if os.path.exists(output_path) and os.path.samefile(source_path, output_path):
+        return True
+    temp_path = f'{output_path}.{threading.get_ident()}.tmp'
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source_path, temp_path)
+        linked = True
+    except OSError:
+        shutil.copyfile(source_path, temp_path)
+        linked = False
+    os.replace(temp_path, output_path)
+    return linked
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_render_store() -> RenderStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = RenderStore(os.path.join(os.curdir, 'prepared', 'renders'))
+        return _store
@@ -0,0 +1,302 @@
+import atexit
+import base64
+import json
+import os.path
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from typing import List
+
+import websocket
+
+import commands
+from utils import status, ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument('--renderer', default='chrome', choices=['chrome', 'native'],
+                    help='Render placards with headless Chrome, or in-process with resvg (needs the template fonts installed or in --font_dir)')
+parser.add_argument('--font_dir', default=None,
+                    help='Directory of extra fonts (e.g. Roboto and Roboto Condensed) for --renderer native')
+parser.add_argument('--chrome', default='google-chrome',
+                    help='Chrome/Chromium executable used for rendering')
+parser.add_argument('--chrome_instances', default=None, type=int,
+                    help='Number of long-lived headless Chrome instances used for rendering (defaults to --jobs)')
+
+# How long to wait for Chrome to come up and for a single page to render.
+STARTUP_TIMEOUT = 30
+RENDER_TIMEOUT = 60
+
+
+class _DevToolsConnection:
+    """Minimal, synchronous client for the Chrome DevTools protocol."""
+
+    def __init__(self, ws_url: str):
+        self.__ws = websocket.create_connection(
+            ws_url, timeout=RENDER_TIMEOUT, suppress_origin=True)
+        self.__next_id = 0
+        self.__events = []
+
+    def call(self, method: str, session_id: str = None, **params):
+        self.__next_id += 1
+        message = {'id': self.__next_id, 'method': method, 'params': params}
+        if session_id is not None:
+            message['sessionId'] = session_id
+        self.__ws.send(json.dumps(message))
+        while True:
+            response = self.__recv()
+            if response.get('id') != self.__next_id:
+                continue
+            if 'error' in response:
+                raise Exception(
+                    f'DevTools call {method} failed: {response["error"].get("message")}')
+            return response.get('result', {})
+
+    def wait_for_event(self, method: str, session_id: str = None):
+        deadline = time.monotonic() + RENDER_TIMEOUT
+        while True:
+            for event in self.__events:
+                if event['method'] == method and event.get('sessionId') == session_id:
+                    self.__events.remove(event)
+                    return event.get('params', {})
+            if time.monotonic() > deadline:
+                raise Exception(f'Timed out waiting for DevTools event {method}')
+            self.__recv()
+
+    def clear_events(self):
+        self.__events = []
+
+    def close(self):
+        self.__ws.close()
+
+    def __recv(self):
+        message = json.loads(self.__ws.recv())
+        if 'method' in message:
+            self.__events.append(message)
+        return message
+
+
+class ChromeInstance:
+    """A single long-lived headless Chrome with one tab used for rendering."""
+
+    def __init__(self, chrome: str):
+        self.__user_data_dir = tempfile.mkdtemp(prefix='placgen-chrome-')
+        self.__process = commands.start(
+            [chrome, '--headless', '--hide-scrollbars', '--no-first-run',
+             '--no-default-browser-check', '--remote-debugging-port=0',
+             f'--user-data-dir={self.__user_data_dir}', 'about:blank'])
+        self.__devtools = None
+        try:
+            self.__devtools = _DevToolsConnection(self.__browser_ws_url())
+            target_id = self.__devtools.call(
+                'Target.createTarget', url='about:blank')['targetId']
+            self.__session_id = self.__devtools.call(
+                'Target.attachToTarget', targetId=target_id, flatten=True)['sessionId']
+            self.__call('Page.enable')
+            self.__call('Emulation.setScrollbarsHidden', hidden=True)
+        except Exception:
+            self.close()
+            raise
+
+    def __browser_ws_url(self) -> str:
+        # Chrome writes the port it picked (and the browser target path) here
+        # once the DevTools server is listening.
+        port_file = os.path.join(self.__user_data_dir, 'DevToolsActivePort')
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.__process.poll() is not None:
+                raise Exception(
+                    f'Chrome exited during startup with code {self.__process.returncode}: {self.__process.stderr() or "no output"}.  Do you have google-chrome installed?')
+            if os.path.isfile(port_file):
+                with open(port_file, 'r') as f:
+                    lines = f.read().splitlines()
+                if len(lines) >= 2:
+                    return f'ws://127.0.0.1:{lines[0]}{lines[1]}'
+            time.sleep(0.05)
+        raise Exception(f'Timed out waiting for Chrome to start: {self.__process.stderr() or "no output"}')
+
+    def __call(self, method: str, **params):
+        return self.__devtools.call(method, self.__session_id, **params)
+
+    def render(self, svg_path: str, window_size: int = None, pdf: bool = False, pdf_options: dict = None):
+        """Loads svg_path once and returns (png_bytes, pdf_bytes).
+
+        A PNG screenshot of a window_size x window_size viewport is taken if
+        window_size is given, and the page is printed to PDF if pdf is True.
+        """
+        if window_size is not None:
+            self.__call('Emulation.setDeviceMetricsOverride', width=window_size,
+                        height=window_size, deviceScaleFactor=1, mobile=False)
+        else:
+            self.__call('Emulation.clearDeviceMetricsOverride')
+
+        self.__devtools.clear_events()
+        result = self.__call(
+            'Page.navigate', url=f'file://{os.path.abspath(svg_path)}')
+        if 'errorText' in result:
+            raise Exception(
+                f'Failed to load {svg_path}: {result["errorText"]}')
+        self.__devtools.wait_for_event('Page.loadEventFired', self.__session_id)
+        # Web fonts are imported by the template, make sure they are in use.
+        self.__call('Runtime.evaluate', expression='document.fonts.ready.then(() => true)',
+                    awaitPromise=True)
+
+        png_data = None
+        pdf_data = None
+        if window_size is not None:
+            png_data = base64.b64decode(self.__call(
+                'Page.captureScreenshot', format='png')['data'])
+        if pdf:
+            options = {'displayHeaderFooter': False}
+            options.update(pdf_options or {})
+            pdf_data = base64.b64decode(
+                self.__call('Page.printToPDF', **options)['data'])
+        return (png_data, pdf_data)
+
+    def close(self):
+        if self.__devtools is not None:
+            try:
+                self.__devtools.close()
+            except Exception:
+                pass
+            self.__devtools = None
+        self.__process.stop()
+        shutil.rmtree(self.__user_data_dir, ignore_errors=True)
+
+
+class Renderer:
+    """Turns an SVG (or, for Chrome, any page) into a PNG and/or a PDF.
+
+    name identifies the backend, so that anything cached from a render can
+    tell which backend produced it.
+    """
+    name = None
+
+    def render_bytes(self, svg_path: str, window_size: int = None, pdf: bool = False, pdf_options: dict = None):
+        """Renders svg_path once and returns (png_bytes, pdf_bytes) without
+        touching the filesystem.
+
+        A PNG of the top left window_size x window_size pixels is made if
+        window_size is given, and a PDF printed with pdf_options (those of
+        Chrome's Page.printToPDF) if pdf is True.
+        """
+        raise NotImplementedError()
+
+    def render(self, svg_path: str, png_path: str = None, pdf_path: str = None, window_size: int = None, pdf_options: dict = None):
+        """Renders svg_path once, writing a screenshot to png_path and/or a
+        printed PDF to pdf_path."""
+        if png_path is not None and window_size is None:
+            raise Exception('A window size is required to render a PNG')
+        (png_data, pdf_data) = self.render_bytes(
+            svg_path, window_size if png_path is not None else None, pdf_path is not None, pdf_options)
+
+        if png_path is not None:
+            with open(png_path, 'wb') as f:
+                f.write(png_data)
+        if pdf_path is not None:
+            with open(pdf_path, 'wb') as f:
+                f.write(pdf_data)
+
+    def close(self):
+        pass
+
+
+class RenderPool(Renderer):
+    """Hands out up to `size` long-lived Chrome instances to render requests.
+
+    Instances are started lazily and reused across renders.  An instance that
+    fails mid-render is thrown away and replaced on the next request.
+    """
+
+    name = 'chrome'
+
+    def __init__(self, chrome: str, size: int = 1):
+        self.__chrome = chrome
+        self.__size = max(1, size)
+        self.__idle = queue.Queue()
+        self.__instances: List[ChromeInstance] = []
+        # Slots reserved by instances still starting up
+        self.__starting = 0
+        self.__lock = threading.Lock()
+
+    def __acquire(self) -> ChromeInstance:
+        while True:
+            try:
+                return self.__idle.get_nowait()
+            except queue.Empty:
+                pass
+            # Chrome takes a while to start, so the slot is reserved under the
+            # lock but Chrome is started outside of it
+            with self.__lock:
+                start = len(self.__instances) + self.__starting < self.__size
+                if start:
+                    self.__starting += 1
+            if start:
+                status.write('Starting headless Chrome')
+                instance = None
+                try:
+                    instance = ChromeInstance(self.__chrome)
+                    return instance
+                finally:
+                    # If Chrome didn't start the slot is free again
+                    with self.__lock:
+                        self.__starting -= 1
+                        if instance is not None:
+                            self.__instances.append(instance)
+            # Wait for a busy instance, re-checking in case one was discarded.
+            try:
+                return self.__idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def __discard(self, instance: ChromeInstance):
+        with self.__lock:
+            self.__instances.remove(instance)
+        instance.close()
+
+    def render_bytes(self, svg_path: str, window_size: int = None, pdf: bool = False, pdf_options: dict = None):
+        with status.span('Rendering', svg=svg_path, png=window_size is not None, pdf=pdf):
+            instance = self.__acquire()
+            try:
+                result = instance.render(svg_path, window_size, pdf, pdf_options)
+            except Exception as e:
+                self.__discard(instance)
+                raise Exception(f'Failed to render {svg_path}: {e}') from e
+            self.__idle.put(instance)
+            return result
+
+    def close(self):
+        with self.__lock:
+            instances = self.__instances
+            self.__instances = []
+        for instance in instances:
+            instance.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_renderer() -> Renderer:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            args = parser.parse_args()
+            if args.renderer == 'native':
+                from native_renderer import NativeRenderer
+                _pool = NativeRenderer(args.font_dir)
+            else:
+                _pool = RenderPool(
+                    args.chrome, args.chrome_instances or args.jobs)
+            atexit.register(_pool.close)
+        return _pool
+
+
+def set_renderer(renderer: Renderer):
+    """Replaces what get_renderer() returns, e.g. with a stand-in that needs
+    no browser."""
+    global _pool
+    with _pool_lock:
+        _pool = renderer
@@ -0,0 +1,113 @@
+import csv
+import json
+import os.path
+import os
+import re
+from typing import Dict, List, Tuple
+
+from utils import status
+
+# (spreadsheet id, A1 range), e.g. ('1jbha...', 'Placards!A2:H')
+SheetRange = Tuple[str, str]
+
+
+class SheetSource:
+    """Where the rows of the placard spreadsheet come from."""
+
+    def read(self, ranges: List[SheetRange]) -> Dict[SheetRange, List[List[str]]]:
+        """The rows of each of ranges, as Sheets returns them: trailing empty
+        cells and rows are left off."""
+        raise NotImplementedError()
+
+
+def pad_rows(rows: List[List[str]], min_cols: int) -> List[List[str]]:
+    if not rows:
+        status.write('No data found.')
+        return []
+    for row in rows:
+        while len(row) < min_cols:
+            row.append('')
+    return rows
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def _trimmed(rows: List[List[str]]) -> List[List[str]]:
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def select_range(rows: List[List[str]], range_name: str) -> List[List[str]]:
+    """The part of a whole tab's rows (e.g. a CSV export of it) that
+    range_name ('Tab!A2:H') selects."""
+    match = re.match(r"^(?:.*!)?([A-Z]+)([0-9]+)?(?::([A-Z]+)([0-9]+)?)?$", range_name)
+    if match is None:
+        raise Exception(f'Not able to interpret {range_name} as an A1 range.')
+    (first_col, first_row, last_col, last_row) = match.groups()
+    first_col = _column_index(first_col)
+    last_col = _column_index(last_col) if last_col else first_col
+    first_row = int(first_row) - 1 if first_row else 0
+    last_row = int(last_row) if last_row else len(rows)
+    return _trimmed([row[first_col:last_col + 1] for row in rows[first_row:last_row]])
+
+
+def _tab_name(range_name: str) -> str:
+    if '!' not in range_name:
+        raise Exception(f'{range_name} does not name a tab.')
+    return range_name.rsplit('!', 1)[0].strip("'")
+
+
+class SnapshotSheetSource(SheetSource):
+    """Rows from a local copy of the spreadsheet, so that runs need no
+    network (and always see the same rows).
+
+    The snapshot is either a JSON file as written by write_snapshot(),
+    or a directory of CSV exports of whole tabs named <tab>.csv.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+
+    def read(self, ranges: List[SheetRange]) -> Dict[SheetRange, List[List[str]]]:
+        status.write(f'Reading spreadsheet snapshot {self.__path}')
+        if os.path.isdir(self.__path):
+            return {(spreadsheet_id, range_name): self.__read_csv(range_name)
+                    for (spreadsheet_id, range_name) in ranges}
+
+        with open(self.__path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        values = {}
+        for (spreadsheet_id, range_name) in ranges:
+            rows = snapshot.get(spreadsheet_id, {}).get(range_name)
+            if rows is None:
+                raise Exception(
+                    f'{range_name} of spreadsheet {spreadsheet_id} is not in {self.__path}')
+            values[(spreadsheet_id, range_name)] = rows
+        return values
+
+    def __read_csv(self, range_name: str) -> List[List[str]]:
+        csv_path = os.path.join(self.__path, f'{_tab_name(range_name)}.csv')
+        with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+            return select_range(list(csv.reader(f)), range_name)
+
+
+def write_snapshot(path: str, values: Dict[SheetRange, List[List[str]]]):
+    """Writes values, as returned by SheetSource.read(), to path in the
+    JSON form that SnapshotSheetSource reads."""
+    snapshot = {}
+    for ((spreadsheet_id, range_name), rows) in values.items():
+        snapshot.setdefault(spreadsheet_id, {})[range_name] = rows
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
@@ -2,15 +2,36 @@ import base64
 from genericpath import exists
 import os.path
 import os
+import math
 import re
+import threading
 from urllib.parse import urlencode
 from xmlrpc.client import ResponseError
-import requests
 import defusedxml.ElementTree
-from utils import Hashes, PreparedPlacard, make_hash_stable_pdf, status, ArgumentParser, syscmd, OutputFile
+from xml.etree import ElementTree
+from images import normalize_logo, optimize_png
+from layout import length_in_inches
+from logo_cache import get_logo_cache
+from render_store import get_render_store, render_key
+from renderer import get_renderer
+from utils import Hashes, PreparedPlacard, PDF_CROP_MARGIN, output_savings, write_hash_stable_pdf, status, ArgumentParser, OutputFile
 
 template_svg_path = os.path.join(os.curdir, 'templates/square_template.svg')
 
+# Every placard's outputs, by type
+OUTPUT_TYPES = {
+    'SVG': 'image/svg+xml',
+    'PNG': 'image/png',
+    'PDF': 'application/pdf',
+}
+
+# Resolution logos are resampled to, enough for the printed placard
+LOGO_DPI = 300
+
+# Bump whenever the way outputs are made from an SVG changes (e.g. how they
+# are optimized), so that placards built the old way are rendered again
+RENDER_VERSION = 2
+
 
 def prepare_template(placard_dir, brewer, beer, style, abv, logo_url, brewery_font_size, beer_font_size, style_font_size,scale=1):
     template = SimpleTemplate(
@@ -18,11 +39,193 @@ def prepare_template(placard_dir, brewer, beer, style, abv, logo_url, brewery_fo
     return template
 
 
+def fingerprint_inputs(placard_dir, scale=1):
+    """Values and files a placard is built from besides its sheet row."""
+    return ([str(scale), get_renderer().name, str(RENDER_VERSION)], [
+        template_svg_path,
+        os.path.join(placard_dir, 'custom.png'),
+        os.path.join(placard_dir, 'downloaded.png')])
+
+
+def _style_to_dict(style):
+    if style == None or style == '':
+        return {}
+    return {t[0]: t[1] for t in (e.split(':') for e in style.split(';'))}
+
+
+def _dict_to_style(style):
+    if len(style) == 0:
+        return ""
+    # Sort the keys so that the SVG is hash-stable with the same inputs
+    keys = list(style.keys())
+    keys.sort()
+    return ';'.join([f'{key}:{style[key]}' for key in keys])
+
+
+def _scale_length(raw, scale):
+    match = re.match('^([0-9]+|[0-9]+\.[0-9]+)([a-z][a-z]|%)$', raw)
+    if match is None:
+        raise Exception(f'Not able to interpret {raw} as a length.')
+
+    number = float(match.group(1))
+    if '%' == match.group(2):
+        # Percentage values are just set to the scale as a percentage
+        number = scale * 100
+    else:
+        # Actual numbers are scaled by the scaling factor
+        number = number * scale
+
+    return f'{number}{match.group(2)}'
+
+
+def _abv_band(abv):
+    if abv < 6:
+        return 'normal'
+    elif abv < 9:
+        return 'strong'
+    return 'boozy'
+
+
+# Elements hidden for each ABV band
+_HIDDEN_IDS = {
+    'normal': ['imgNormalGray', 'imgStrong', 'imgBoozy', 'rectRed', 'rectStripes', 'txtAbvBlur'],
+    'strong': ['imgNormal', 'imgStrongGray', 'imgBoozy', 'rectRed', 'rectStripes'],
+    'boozy': ['imgNormal', 'imgStrong', 'imgBoozyGray'],
+}
+
+# Text slots hold the text and style of the element's first child (the tspan)
+_TEXT_SLOTS = ['txtBrewer', 'txtBeer', 'txtStyle', 'txtAbv', 'txtAbvBlur']
+_ATTRIBUTE_SLOTS = [
+    ('imgLogo', '{http://www.w3.org/1999/xlink}href'),
+    ('abvLine', 'd'),
+]
+_ROOT_ATTRIBUTE_SLOTS = ['width', 'height']
+
+
+class CompiledTemplate:
+    """The square template, parsed and serialized once per ABV band.
+
+    Everything that only depends on the ABV band (hidden elements, ABV text
+    color) is applied up front and the result is split into literal chunks
+    around named slots.  Filling the slots produces exactly the bytes
+    ElementTree would have written for the same edits.
+
+    Slots are named '<id>@<attribute>' for attributes, with 'svg' standing in
+    for the root element, and '<id>#text'/'<id>#style' for the text and style
+    of the element's first child.  A slot whose attribute is missing from the
+    template only emits the attribute when it is given a value.
+    """
+    __MARK = '\ue000'
+
+    def __init__(self, template_path, band):
+        e = defusedxml.ElementTree.parse(template_path)
+        root = e.getroot()
+        self.__defaults = {}
+        self.__escapes = {}
+        self.__optional = set()
+        self.__optional_wrappers = {}
+        self.__attributes = {'svg': dict(root.attrib)}
+        for node in root.iter():
+            if node.get('id') is not None:
+                self.__attributes[node.get('id')] = dict(node.attrib)
+
+        for id in _HIDDEN_IDS[band]:
+            node = root.find(f".//*[@id='{id}']")
+            nodeStyle = _style_to_dict(node.get('style'))
+            nodeStyle['display'] = "none"
+            node.set('style', _dict_to_style(nodeStyle))
+
+        if band != 'normal':
+            # Change ABV text color
+            txtAbv = root.find(".//*[@id='txtAbv']")
+            txtAbvStyle = _style_to_dict(txtAbv.get('style'))
+            txtAbvStyle['fill'] = '#ff0030'
+            txtAbvStyle['stroke'] = '#e0e0e0'
+            txtAbv.set('style', _dict_to_style(txtAbvStyle))
+
+        # The ABV line's style is always normalized
+        abvLine = root.find(".//*[@id='abvLine']")
+        abvLine.set('style', _dict_to_style(_style_to_dict(abvLine.get('style'))))
+
+        # Slot values are escaped with ElementTree's own helpers so that the
+        # output matches what ElementTree.write() produces byte for byte.
+        for id in _TEXT_SLOTS:
+            node = root.find(f".//*[@id='{id}']")[0]
+            node.text = self.__slot(f'{id}#text', node.text, ElementTree._escape_cdata)
+            node.set('style', self.__slot(
+                f'{id}#style', node.get('style'), ElementTree._escape_attrib))
+        for id, attribute in _ATTRIBUTE_SLOTS:
+            node = root.find(f".//*[@id='{id}']")
+            name = f"{id}@{attribute.split('}')[-1]}"
+            node.set(attribute, self.__slot(
+                name, node.get(attribute), ElementTree._escape_attrib))
+        for attribute in _ROOT_ATTRIBUTE_SLOTS:
+            root.set(attribute, self.__slot(
+                f'svg@{attribute}', root.get(attribute), ElementTree._escape_attrib))
+
+        # Alternating literal chunks and slot names
+        self.__chunks = ElementTree.tostring(
+            root, encoding='unicode').split(self.__MARK)
+
+        # Optional attributes own their ' name="..."' wrapper so that it can
+        # be left out entirely.
+        for i in range(1, len(self.__chunks), 2):
+            name = self.__chunks[i]
+            if name in self.__optional:
+                (before, wrapper) = self.__chunks[i-1].rsplit(' ', 1)
+                self.__chunks[i-1] = before
+                self.__chunks[i+1] = self.__chunks[i+1][1:]
+                self.__optional_wrappers[name] = f' {wrapper}'
+
+    def __slot(self, name, default, escape):
+        self.__defaults[name] = default
+        self.__escapes[name] = escape
+        if default is None:
+            self.__optional.add(name)
+        return f'{self.__MARK}{name}{self.__MARK}'
+
+    def default(self, name):
+        return self.__defaults[name]
+
+    def attribute(self, id, name):
+        """The template's own value for an attribute of element id."""
+        return self.__attributes[id].get(name)
+
+    def fill(self, values) -> bytes:
+        """Returns the placard SVG with the given slot values, using the
+        template's values for any slot not given."""
+        parts = self.__chunks[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            value = values[name] if name in values else self.__defaults[name]
+            if value is None:
+                parts[i] = ''
+            elif name in self.__optional:
+                parts[i] = f'{self.__optional_wrappers[name]}{self.__escapes[name](value)}"'
+            else:
+                parts[i] = self.__escapes[name](value)
+        # Same encoding ElementTree.write() uses by default
+        return ''.join(parts).encode('us-ascii', 'xmlcharrefreplace')
+
+
+_compiled_templates = {}
+_compiled_templates_lock = threading.Lock()
+
+
+def compiled_template(abv) -> CompiledTemplate:
+    band = _abv_band(abv)
+    with _compiled_templates_lock:
+        if band not in _compiled_templates:
+            _compiled_templates[band] = CompiledTemplate(
+                template_svg_path, band)
+        return _compiled_templates[band]
+
+
 class SimpleTemplate(PreparedPlacard):
 
     def __init__(self, placard_dir, brewer, beer, style, abv, logo_url, brewery_font_size, beer_font_size, style_font_size, scale):
         super().__init__(f'{brewer} - {beer}', placard_dir)
-        self.__hashes = Hashes(os.path.join(placard_dir, 'hashes.md5'))
+        self.__hashes = Hashes(placard_dir)
         self.brewer = brewer
         self.beer = beer
         self.style = style
@@ -33,12 +236,9 @@ class SimpleTemplate(PreparedPlacard):
         self.style_font_size = None if not style_font_size else style_font_size
         self.__image_file = None
         stem = os.path.join(placard_dir, 'placard')
-        self.output_files['SVG'] = OutputFile(
-            'SVG', 'image/svg+xml', stem + '.svg', self.__hashes)
-        self.output_files['PNG'] = OutputFile(
-            'PNG', 'image/png', stem + '.png', self.__hashes)
-        self.output_files['PDF'] = OutputFile(
-            'PDF', 'application/pdf', stem + '.pdf', self.__hashes)
+        for type, mime_type in OUTPUT_TYPES.items():
+            self.output_files[type] = OutputFile(
+                type, mime_type, f'{stem}.{type.lower()}', self.__hashes)
         self.__scale = scale
         self.processed = self.__process()
 
@@ -52,77 +252,44 @@ class SimpleTemplate(PreparedPlacard):
             return ''
         return ' '.join([','.join(e) for e in d])
 
-    def __style_to_dict(self, style):
-        if style == None or style == '':
-            return {}
-        return {t[0]: t[1] for t in (e.split(':') for e in style.split(';'))}
-
-    def __dict_to_style(self, style):
-        if len(style) == 0:
-            return ""
-        # Sort the keys so that the SVG is hash-stable with the same inputs
-        keys = list(style.keys())
-        keys.sort()
-        return ';'.join([f'{key}:{style[key]}' for key in keys])
-
     def __data_url_for_png(self, png_path) -> str:
+        # Custom (and older downloaded) logos can be any size, so they are
+        # normalized here too.  This is a cheap no-op for logos that already are.
         with open(png_path, 'rb+') as f:
-            return 'data:image/png;base64,' + str(base64.b64encode(f.read()), encoding='utf8')
-
-    def __set_text_and_size(self, root, node_xpath, text, text_size):
-        node = root.find(node_xpath)[0]
-        node.text = text
+            data = normalize_logo(f.read(), *self.__logo_pixel_size())
+        return 'data:image/png;base64,' + str(base64.b64encode(data), encoding='utf8')
+
+    def __logo_pixel_size(self):
+        # The number of pixels imgLogo covers when printed at LOGO_DPI
+        template = compiled_template(self.abv)
+        (width, _) = self.__size_in_inches()
+        viewBox = [float(v) for v in template.attribute('svg', 'viewBox').split()]
+        inches_per_unit = width / viewBox[2]
+        return (
+            math.ceil(float(template.attribute('imgLogo', 'width')) * inches_per_unit * LOGO_DPI),
+            math.ceil(float(template.attribute('imgLogo', 'height')) * inches_per_unit * LOGO_DPI))
+
+    def __text_and_size(self, template, values, id, text, text_size):
+        values[f'{id}#text'] = text
         if text_size:
-            nodeStyle = self.__style_to_dict(node.get('style'))
+            nodeStyle = _style_to_dict(template.default(f'{id}#style'))
             nodeStyle['font-size'] = f"{text_size}px"
-            node.set('style', self.__dict_to_style(nodeStyle))
+            values[f'{id}#style'] = _dict_to_style(nodeStyle)
 
     def __transform_svg(self):
-        # Load SVG template
-        e = defusedxml.ElementTree.parse(template_svg_path)
-        root = e.getroot()
+        template = compiled_template(self.abv)
+        values = {}
 
         # Update text values and apply custom font sizing
-        self.__set_text_and_size(root, ".//*[@id='txtBrewer']", self.brewer, self.brewery_font_size)
-        self.__set_text_and_size(root, ".//*[@id='txtBeer']", self.beer, self.beer_font_size)
-        self.__set_text_and_size(root, ".//*[@id='txtStyle']", self.style, self.style_font_size)
-        self.__set_text_and_size(root, ".//*[@id='txtAbv']", f"{self.abv:.1f}", None)
-        self.__set_text_and_size(root, ".//*[@id='txtAbvBlur']", f"{self.abv:.1f}", None)
+        self.__text_and_size(template, values, 'txtBrewer', self.brewer, self.brewery_font_size)
+        self.__text_and_size(template, values, 'txtBeer', self.beer, self.beer_font_size)
+        self.__text_and_size(template, values, 'txtStyle', self.style, self.style_font_size)
+        self.__text_and_size(template, values, 'txtAbv', f"{self.abv:.1f}", None)
+        self.__text_and_size(template, values, 'txtAbvBlur', f"{self.abv:.1f}", None)
 
         # Update image if one is present
         if self.__image_file is not None:
-            root.find(".//*[@id='imgLogo']").set(
-                "{http://www.w3.org/1999/xlink}href", self.__data_url_for_png(self.__image_file))
-
-        # ABV Images
-        hideIds = []
-        if self.abv < 6:
-            hideIds += ['imgNormalGray', 'imgStrong',
-                        'imgBoozy', 'rectRed', 'rectStripes', 'txtAbvBlur']
-        elif 6 <= self.abv < 9:
-            hideIds += ['imgNormal', 'imgStrongGray',
-                        'imgBoozy', 'rectRed', 'rectStripes']
-        elif self.abv >= 9:
-            hideIds += ['imgNormal', 'imgStrong', 'imgBoozyGray']
-
-        for id in hideIds:
-            node = root.find(f".//*[@id='{id}']")
-            nodeStyle = self.__style_to_dict(node.get('style'))
-            nodeStyle['display'] = "none"
-            node.set('style', self.__dict_to_style(nodeStyle))
-
-        # ABV Line
-        abvLine = root.find(".//*[@id='abvLine']")
-        abvLineStyle = self.__style_to_dict(abvLine.get('style'))
-        abvLineInstr = self.__path_d_to_list(abvLine.get('d'))
-
-        if self.abv >= 6:
-            # Change ABV text color
-            txtAbv = root.find(".//*[@id='txtAbv']")
-            txtAbvStyle = self.__style_to_dict(txtAbv.get('style'))
-            txtAbvStyle['fill'] = '#ff0030'
-            txtAbvStyle['stroke'] = '#e0e0e0'
-            txtAbv.set('style', self.__dict_to_style(txtAbvStyle))
+            values['imgLogo@href'] = self.__data_url_for_png(self.__image_file)
 
         # Size the ABV line so that it represents the ABV of
         # this beer.
@@ -131,6 +298,7 @@ class SimpleTemplate(PreparedPlacard):
         #
         # The line path instructions are expected to be
         #   "M X1,Y H X2"
+        abvLineInstr = self.__path_d_to_list(template.default('abvLine@d'))
         start = float(abvLineInstr[1][0])
         end = float(abvLineInstr[3][0])
         deltaAbv = self.abv - 4
@@ -140,65 +308,38 @@ class SimpleTemplate(PreparedPlacard):
         elif adjusted > end:
             adjusted = end
         abvLineInstr[3][0] = str(adjusted)
-        abvLine.set('style', self.__dict_to_style(abvLineStyle))
-        abvLine.set('d', self.__list_to_path_d(abvLineInstr))
+        values['abvLine@d'] = self.__list_to_path_d(abvLineInstr)
 
         if self.__scale != 1:
             # Transform the width/height of the root svg by the given scale
-            self.__scale_length_propery(root, 'width')
-            self.__scale_length_propery(root, 'height')
-
-        e.write(self.output_files['SVG'].file_path)
-
-    def __scale_length_propery(self, element, property):
-        raw = element.get(property)
-        match = re.match('^([0-9]+|[0-9]+\.[0-9]+)([a-z][a-z]|%)$', raw)
-        if match is None:
-            raise Exception(f'Not able to interpret {raw} as a length.')
-
-        number = float(match.group(1))
-        if '%' == match.group(2):
-            # Percentage values are just set to the scale as a percentage
-            number = self.__scale * 100
-        else:
-            # Actual numbers are scaled by the scaling factor
-            number = number * self.__scale
-
-        element.set(property, f'{number}{match.group(2)}')
-
-    def __download_image_as_png(self):
-        ContentTypes = {
-            'image/jpeg': 'jpg',
-            'image/png': 'png',
-            'image/webp': 'webp',
-        }
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/101.0.4951.64 Safari/537.36'}
-        with requests.get(self.logo_url, headers=headers) as response:
-            response.raise_for_status()
-
-            contentType = response.headers['Content-Type']
-            if contentType not in ContentTypes:
-                raise Exception(
-                    f'Unsupported Content-Type: {contentType} from {self.logo_url}')
-            download_path = os.path.join(
-                self.placard_dir, f'downloaded.{ContentTypes[contentType]}')
-            with open(download_path, 'wb+') as f:
-                f.write(response.content)
-                f.close()
-            if contentType != 'image/png':
-                png_path = os.path.splitext(download_path)[0] + '.png'
-                if syscmd(f'convert {download_path} {png_path}') != 0:
-                    raise Exception(
-                        f'Failed to convert {download_path} to {png_path}.  Do you have convert install?')
-                else:
-                    os.remove(download_path)
-                download_path = png_path
-
-            if syscmd(f'exiftool -overwrite_original -all=  {download_path}') != 0:
-                raise Exception(
-                    f'Failed to strip exif info from downloaded file.  Do you have exiftool installed?')
-            self.__image_file = download_path
+            for property in ['width', 'height']:
+                values[f'svg@{property}'] = _scale_length(
+                    template.default(f'svg@{property}'), self.__scale)
+
+        with open(self.output_files['SVG'].file_path, 'wb') as f:
+            f.write(template.fill(values))
+
+    def __cached_logo(self, downloaded_file):
+        try:
+            return get_logo_cache().get(self.logo_url)
+        except Exception as e:
+            if not os.path.isfile(downloaded_file):
+                raise
+            # The last download is still better than no logo
+            status.write(f'Keeping the last download of {self.logo_url}: {e}')
+            return None
+
+    def __download_image_as_png(self, logo=None):
+        # Logos are fetched up front into the logo cache, this just converts
+        # it to a PNG sized for this placard.
+        if logo is None:
+            logo = get_logo_cache().get(self.logo_url)
+        with open(logo.path, 'rb') as f:
+            data = f.read()
+        download_path = os.path.join(self.placard_dir, 'downloaded.png')
+        with open(download_path, 'wb') as f:
+            f.write(normalize_logo(data, *self.__logo_pixel_size()))
+        self.__image_file = download_path
 
     def __create_png_and_pdf(self):
         svg_path = self.output_files['SVG'].file_path
@@ -209,26 +350,50 @@ class SimpleTemplate(PreparedPlacard):
         if self.__scale != 1:
             window_size = int(window_size*self.__scale)
 
-        if syscmd(f'google-chrome --headless --window-size={window_size}x{window_size} --screenshot --hide-scrollbars {svg_path}') != 0:
-            raise Exception(f"Failed to convert {svg_path} to PNG")
-
-        if syscmd(f"google-chrome --headless --print-to-pdf --print-to-pdf-no-header {svg_path}") != 0:
-            raise Exception(f"Failed to convert {svg_path} to PDF")
-
-        # Chrome dumps 'output.pdf' and 'screenshot.png' in curdir
-        if syscmd(f'mv output.pdf {pdf_path}') != 0:
-            raise Exception(f'Failed to mv ./output.pdf to {pdf_path}')
-        if syscmd(f'mv screenshot.png {png_path}') != 0:
-            raise Exception(
-                f'Failed to mv ./screenshot.png to {png_path}')
-
-        # Crop the PDF and add a margin, as chrome saves with a bunch of extra whitespace.
-        if syscmd(f"pdfcrop -margin 24 {pdf_path} {pdf_path}") != 0:
-            raise Exception(
-                f"Failed to crop {pdf_path}.  Do you have pdfcrop installed?")
+        (width, height) = self.__size_in_inches()
+        pdf_options = {
+            'paperWidth': width,
+            'paperHeight': height,
+            'marginTop': 0,
+            'marginBottom': 0,
+            'marginLeft': 0,
+            'marginRight': 0,
+            'pageRanges': '1',
+        }
 
-        # Make the PDF hash stable by getting rid of metadata and dynamic ids
-        make_hash_stable_pdf(pdf_path)
+        def render(paths):
+            # Screenshot and print from a single load of the SVG.  The PDF page
+            # is exactly the size of the placard so it is already cropped to it.
+            (png_data, pdf_data) = get_renderer().render_bytes(
+                svg_path, window_size=window_size, pdf=True, pdf_options=pdf_options)
+            optimized_png_data = optimize_png(png_data)
+            with open(paths['placard.png'], 'wb') as f:
+                f.write(optimized_png_data)
+            output_savings.add('PNG', len(png_data), len(optimized_png_data))
+
+            # Add a margin and make the PDF hash stable by getting rid of
+            # metadata and dynamic ids.  Only sharing the images counts as a
+            # saving, dropping the metadata is not an optimization.
+            deduped = write_hash_stable_pdf(pdf_data, paths['placard.pdf'], PDF_CROP_MARGIN)
+            pdf_size = os.path.getsize(paths['placard.pdf'])
+            output_savings.add('PDF', pdf_size + deduped, pdf_size)
+
+        # Identical SVGs (e.g. the same beer on another site) render identically
+        with open(svg_path, 'rb') as f:
+            key = render_key(f.read(), {
+                'renderer': get_renderer().name,
+                'window_size': window_size,
+                'pdf_options': pdf_options,
+                'pdf_margin': PDF_CROP_MARGIN,
+                'version': RENDER_VERSION,
+            })
+        get_render_store().materialize(
+            key, {'placard.png': png_path, 'placard.pdf': pdf_path}, render)
+
+    def __size_in_inches(self):
+        template = compiled_template(self.abv)
+        return tuple(length_in_inches(_scale_length(template.default(f'svg@{property}'), self.__scale))
+                     for property in ['width', 'height'])
 
     def __process(self) -> bool:
         parser = ArgumentParser()
@@ -242,12 +407,20 @@ class SimpleTemplate(PreparedPlacard):
         # it again when it changes.
         self.__hashes.add_blob('logo_url', self.logo_url.encode('utf8'))
 
-        # If the logo_url changed, download it again
-        if self.__hashes.has_changes('logo_url'):
+        # The logo behind the URL can change too (the logo cache revalidates
+        # it), so remember which logo downloaded.png was made from
+        logo = None
+        if len(self.logo_url) != 0 and not os.path.isfile(custom_file):
+            logo = self.__cached_logo(downloaded_file)
+            if logo is not None:
+                self.__hashes.add_blob('logo', logo.sha256.encode('utf8'))
+
+        # If the logo_url (or the logo behind it) changed, download it again
+        if self.__hashes.has_changes('logo_url') or (logo is not None and self.__hashes.has_changes('logo')):
             if len(self.logo_url) != 0:
                 # Download the new URL
-                self.__download_image_as_png()
-            elif os.exists(downloaded_file):
+                self.__download_image_as_png(logo)
+            elif os.path.exists(downloaded_file):
                 # No more URL - delete the download file
                 os.remove(downloaded_file)
 
@@ -280,11 +453,16 @@ class SimpleTemplate(PreparedPlacard):
 
         # Hash output files
         for output_file in self.output_files.values():
-            self.__hashes.add_file(output_file.file_path)
+            self.__hashes.add_output(output_file.file_path)
 
         # Hash the template svg
         self.__hashes.add_file(template_svg_path)
 
+        # Outputs of one renderer (or render version) are different from
+        # another's
+        self.__hashes.add_blob('renderer', get_renderer().name.encode('utf8'))
+        self.__hashes.add_blob('render_version', str(RENDER_VERSION).encode('utf8'))
+
         if not args.force and not self.__hashes.has_changes():
             # Nothing is changed, so nothing needs to be regenerated
             return False
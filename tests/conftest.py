@@ -0,0 +1,19 @@
+import os.path
+import sys
+
+import pytest
+
+# The modules live at the top of the repo rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """Runs the test in an empty directory, like a fresh checkout, with no
+    command line arguments."""
+    import manifest
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['placard.py'])
+    # The manifest is opened in whatever the working directory was first
+    monkeypatch.setattr(manifest, '_manifest', None)
+    return tmp_path
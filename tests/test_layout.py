@@ -0,0 +1,36 @@
+import pytest
+
+from layout import PAPER_SIZES, grid_layout, length_in_inches
+
+# The placard template's size, in inches
+PLACARD = length_in_inches('2.9000001in')
+MARGIN = 0.4
+
+
+def check_fits(layout, margin):
+    (paper_width, paper_height) = layout.paper_size
+    (width, height) = layout.placard_size
+    for (x, y) in layout.slots:
+        assert margin <= x and x + width <= paper_width - margin
+        assert margin <= y and y + height <= paper_height - margin
+    for (n, (x, y)) in enumerate(layout.slots):
+        for (other_x, other_y) in layout.slots[n + 1:]:
+            assert abs(x - other_x) >= width or abs(y - other_y) >= height
+
+
+def test_full_size_is_6_up():
+    layout = grid_layout(PAPER_SIZES['letter'], MARGIN, (PLACARD, PLACARD))
+    assert layout.capacity == 6
+    check_fits(layout, MARGIN)
+
+
+def test_scaled_is_12_up():
+    size = PLACARD * 0.82
+    layout = grid_layout(PAPER_SIZES['letter'], MARGIN, (size, size))
+    assert layout.capacity == 12
+    check_fits(layout, MARGIN)
+
+
+def test_too_big_for_the_page():
+    with pytest.raises(Exception, match='does not fit'):
+        grid_layout(PAPER_SIZES['letter'], MARGIN, (9, 9))
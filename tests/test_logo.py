@@ -0,0 +1,62 @@
+import functools
+import http.server
+import os.path
+import os
+import shutil
+import threading
+
+import pytest
+from PIL import Image
+
+import logo_cache
+import render_store
+from fakes import StubRenderer
+from placard import GoldPan
+from renderer import set_renderer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def logo_server(workspace, monkeypatch):
+    shutil.copytree(os.path.join(REPO_DIR, 'templates'), 'templates')
+    os.makedirs('served')
+    monkeypatch.setattr(logo_cache, '_cache', None)
+    monkeypatch.setattr(render_store, '_store', None)
+    set_renderer(StubRenderer())
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(_QuietHandler, directory='served'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+    set_renderer(None)
+
+
+def serve_logo(color, mtime):
+    path = os.path.join('served', 'logo.png')
+    Image.new('RGB', (40, 40), color).save(path, format='PNG')
+    os.utime(path, (mtime, mtime))
+
+
+def build(url):
+    placard = GoldPan(os.path.join(os.curdir, 'prepared')).build_placard(
+        'Brewer', 'Beer', 'IPA', '6.5', url, '', '', '')
+    with Image.open(os.path.join(placard.placard_dir, 'downloaded.png')) as logo:
+        return logo.convert('RGB').getpixel((logo.width // 2, logo.height // 2))
+
+
+def test_logo_changed_behind_the_same_url(logo_server, monkeypatch):
+    url = f'{logo_server}/logo.png'
+    serve_logo((255, 0, 0), 1_000_000_000)
+    assert build(url) == (255, 0, 0)
+
+    # Revalidated on every build, and found to have changed
+    monkeypatch.setattr(logo_cache, 'FRESH_SECONDS', 0)
+    serve_logo((0, 0, 255), 1_100_000_000)
+    assert build(url) == (0, 0, 255)
@@ -0,0 +1,47 @@
+import os.path
+import os
+
+import pytest
+
+from fakes import StubRenderer
+from multiprint import create_multiprint_pdf
+from renderer import set_renderer
+
+
+def make_svgs(count):
+    paths = []
+    for n in range(count):
+        path = os.path.join(os.curdir, f'placard{n}.svg')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="3in" height="3in" viewBox="0 0 3 3">'
+                    f'<title>{n}</title></svg>')
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def renderer(workspace):
+    renderer = StubRenderer()
+    set_renderer(renderer)
+    yield renderer
+    set_renderer(None)
+
+
+def test_unused_pages_are_pruned(renderer):
+    pages_dir = os.path.join(os.curdir, 'prepared', 'multiprint', 'pages')
+    svg_paths = make_svgs(8)
+    create_multiprint_pdf(svg_paths)
+    first_pages = set(os.listdir(pages_dir))
+    assert len(first_pages) == 2
+
+    # A placard on the second page changes, replacing that page
+    with open(svg_paths[-1], 'a', encoding='utf-8') as f:
+        f.write('\n')
+    create_multiprint_pdf(svg_paths)
+    pages = set(os.listdir(pages_dir))
+    assert len(pages) == 2
+    assert len(pages & first_pages) == 1
+
+    # Fewer placards, fewer pages
+    create_multiprint_pdf(svg_paths[:3])
+    assert len(os.listdir(pages_dir)) == 1
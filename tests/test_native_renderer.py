@@ -0,0 +1,69 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+from PyPDF2 import PdfReader
+
+pytest.importorskip('resvg_py')
+
+from native_renderer import NativeRenderer
+
+
+def _data_url(color):
+    output = io.BytesIO()
+    Image.new('RGB', (2, 2), color).save(output, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(output.getvalue()).decode('ascii')
+
+
+@pytest.fixture
+def svg_path(tmp_path):
+    # One inch square (96 CSS pixels) in the absolute units the template uses,
+    # with the features the template relies on: a blur, a data URL image and
+    # a hidden element
+    path = tmp_path / 'placard.svg'
+    path.write_text(f'''<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
+     width="1in" height="1in" viewBox="0 0 96 96">
+  <defs><filter id="blur"><feGaussianBlur stdDeviation="4"/></filter></defs>
+  <rect x="0" y="0" width="48" height="48" fill="#ff0000"/>
+  <rect x="48" y="0" width="48" height="48" fill="#0000ff" style="display:none"/>
+  <image x="0" y="48" width="48" height="48" xlink:href="{_data_url((0, 255, 0))}"/>
+  <circle cx="72" cy="72" r="12" fill="#000000" filter="url(#blur)"/>
+</svg>''', encoding='utf-8')
+    return str(path)
+
+
+def test_png(svg_path):
+    (png_data, pdf_data) = NativeRenderer().render_bytes(svg_path, window_size=120)
+    assert pdf_data is None
+    image = Image.open(io.BytesIO(png_data)).convert('RGB')
+    assert image.size == (120, 120)
+    assert image.getpixel((24, 24)) == (255, 0, 0)
+    assert image.getpixel((72, 24)) == (255, 255, 255)
+    assert image.getpixel((24, 72)) == (0, 255, 0)
+    # Blurred: dark in the middle, fading out past the edge of the circle
+    assert max(image.getpixel((72, 72))) < 128
+    assert 0 < image.getpixel((72, 82))[0] < 255
+    assert image.getpixel((110, 110)) == (255, 255, 255)
+
+
+def test_pdf_is_lossless(svg_path):
+    (png_data, pdf_data) = NativeRenderer().render_bytes(
+        svg_path, pdf=True, pdf_options={'paperWidth': 1, 'paperHeight': 1})
+    assert png_data is None
+    assert b'/DCTDecode' not in pdf_data
+    page = PdfReader(io.BytesIO(pdf_data)).pages[0]
+    assert (float(page.mediabox.width), float(page.mediabox.height)) == (72, 72)
+    (raster,) = [x.get_object() for x in page['/Resources']['/XObject'].values()]
+    assert raster['/Filter'] == '/FlateDecode'
+    image = Image.frombytes('RGB', (raster['/Width'], raster['/Height']), raster.get_data())
+    assert image.size == (600, 600)
+    # Exact colours survive, which they wouldn't through JPEG
+    assert image.getpixel((150, 150)) == (255, 0, 0)
+    assert image.getpixel((150, 450)) == (0, 255, 0)
+    assert image.getpixel((450, 150)) == (255, 255, 255)
+
+
+def test_rejects_other_documents(tmp_path):
+    with pytest.raises(Exception, match='only renders SVG'):
+        NativeRenderer().render_bytes(str(tmp_path / 'multiprint.html'), window_size=100)
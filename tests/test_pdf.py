@@ -0,0 +1,56 @@
+import io
+import os.path
+import zlib
+
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, EncodedStreamObject, NameObject, NumberObject
+
+from utils import write_hash_stable_pdf
+
+
+def image(writer, pixels):
+    # Each with its own (identical) ICC profile, like Chrome writes them
+    profile = DecodedStreamObject()
+    profile.set_data(b'not really a profile')
+    profile[NameObject('/N')] = NumberObject(3)
+    profile[NameObject('/Alternate')] = NameObject('/DeviceRGB')
+    stream = EncodedStreamObject()
+    stream._data = zlib.compress(pixels)
+    stream.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Image'),
+        NameObject('/Width'): NumberObject(len(pixels) // 3),
+        NameObject('/Height'): NumberObject(1),
+        NameObject('/ColorSpace'): ArrayObject([NameObject('/ICCBased'), writer._add_object(profile)]),
+        NameObject('/BitsPerComponent'): NumberObject(8),
+        NameObject('/Filter'): NameObject('/FlateDecode'),
+    })
+    return (writer._add_object(stream), len(stream._data))
+
+
+def pdf_with_images(*images):
+    writer = PdfWriter()
+    page = writer.add_blank_page(72, 72)
+    xobjects = DictionaryObject()
+    sizes = []
+    for n, pixels in enumerate(images):
+        (reference, size) = image(writer, pixels)
+        xobjects[NameObject(f'/Im{n}')] = reference
+        sizes.append(size)
+    page[NameObject('/Resources')] = DictionaryObject({NameObject('/XObject'): xobjects})
+    writer.add_metadata({'/Creator': 'a long creator string that is stripped ' * 10})
+    output = io.BytesIO()
+    writer.write(output)
+    return (output.getvalue(), sizes)
+
+
+def test_only_duplicate_images_count_as_saved(tmp_path):
+    path = str(tmp_path / 'placard.pdf')
+    (pdf_data, _) = pdf_with_images(bytes(range(90)), bytes(range(1, 91)))
+    assert write_hash_stable_pdf(pdf_data, path) == 0
+
+    (pdf_data, sizes) = pdf_with_images(bytes(range(90)), bytes(range(90)), bytes(range(90)))
+    assert write_hash_stable_pdf(pdf_data, path) == sizes[1] + sizes[2]
+    xobjects = PdfReader(path).pages[0]['/Resources']['/XObject']
+    assert len({xobjects.raw_get(name).idnum for name in xobjects}) == 1
+    assert os.path.getsize(path) < len(pdf_data)
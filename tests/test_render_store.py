@@ -0,0 +1,58 @@
+import os.path
+import os
+
+from render_store import RenderStore, render_key
+
+
+def write(text):
+    def render(paths):
+        with open(paths['placard.png'], 'w') as f:
+            f.write(text)
+    return render
+
+
+def entries(store_dir):
+    return sorted(key for prefix in os.listdir(store_dir) for key in os.listdir(os.path.join(store_dir, prefix)))
+
+
+def test_prune_removes_unlinked_renders(tmp_path):
+    store_dir = str(tmp_path / 'renders')
+    store = RenderStore(store_dir)
+    (first, second) = (str(tmp_path / 'first.png'), str(tmp_path / 'second.png'))
+    (old_key, new_key, shared_key) = (render_key(b'old', {}), render_key(b'new', {}), render_key(b'shared', {}))
+    store.materialize(old_key, {'placard.png': first}, write('old'))
+    store.materialize(shared_key, {'placard.png': second}, write('shared'))
+
+    # The first placard changes, leaving its old render unused
+    store.materialize(new_key, {'placard.png': first}, write('new'))
+    store.prune()
+    assert entries(store_dir) == sorted([new_key, shared_key])
+    with open(first) as f:
+        assert f.read() == 'new'
+
+    # Once nothing links to a render any more it goes too
+    os.remove(second)
+    store.prune()
+    assert entries(store_dir) == [new_key]
+
+
+def test_materializing_again_leaves_no_stray_links(tmp_path):
+    store_dir = str(tmp_path / 'renders')
+    store = RenderStore(store_dir)
+    placard_dir = tmp_path / 'placard'
+    placard_dir.mkdir()
+    output = str(placard_dir / 'placard.png')
+    key = render_key(b'same', {})
+
+    # e.g. a --force run, or a rebuild that renders the same SVG
+    store.materialize(key, {'placard.png': output}, write('same'))
+    store.materialize(key, {'placard.png': output}, write('same'))
+    assert os.listdir(placard_dir) == ['placard.png']
+    assert os.stat(output).st_nlink == 2
+
+    # The placard moving to a new key still frees the old entry
+    new_key = render_key(b'new', {})
+    store.materialize(new_key, {'placard.png': output}, write('new'))
+    store.prune()
+    assert entries(store_dir) == [new_key]
+    assert os.listdir(placard_dir) == ['placard.png']
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+import renderer
+from renderer import RenderPool
+
+
+class FakeChrome:
+    """Stands in for ChromeInstance.  Starting blocks until started is set
+    and fails while fail is set."""
+    started = threading.Event()
+    fail = False
+    starts = 0
+
+    def __init__(self, chrome):
+        FakeChrome.starts += 1
+        if not FakeChrome.started.wait(timeout=5):
+            raise Exception('Never started')
+        if FakeChrome.fail:
+            raise Exception('Chrome exited during startup')
+
+    def render(self, svg_path, window_size, pdf, pdf_options):
+        return (b'png', None)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fake_chrome(monkeypatch):
+    monkeypatch.setattr(renderer, 'ChromeInstance', FakeChrome)
+    FakeChrome.started = threading.Event()
+    FakeChrome.fail = False
+    FakeChrome.starts = 0
+
+
+def render_in_thread(pool, results):
+    def render():
+        try:
+            results.append(pool.render_bytes('placard.svg', window_size=100))
+        except Exception as e:
+            results.append(e)
+    thread = threading.Thread(target=render)
+    thread.start()
+    return thread
+
+
+def test_instances_start_concurrently():
+    pool = RenderPool('chrome', 2)
+    results = []
+    threads = [render_in_thread(pool, results) for _ in range(2)]
+    # Both start at once rather than the second waiting on the first
+    for _ in range(50):
+        if FakeChrome.starts == 2:
+            break
+        threading.Event().wait(0.02)
+    assert FakeChrome.starts == 2
+    FakeChrome.started.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert results == [(b'png', None)] * 2
+
+
+def test_failed_start_frees_its_slot():
+    pool = RenderPool('chrome', 1)
+    FakeChrome.started.set()
+    FakeChrome.fail = True
+    with pytest.raises(Exception, match='during startup'):
+        pool.render_bytes('placard.svg', window_size=100)
+
+    FakeChrome.fail = False
+    results = []
+    render_in_thread(pool, results).join(timeout=5)
+    assert results == [(b'png', None)]
+    assert FakeChrome.starts == 2
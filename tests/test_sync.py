@@ -0,0 +1,98 @@
+import os.path
+import os
+
+import pytest
+
+from fakes import FakeDrive
+from gcloud_helper import GCloud, UploadResult
+from utils import Hashes, OutputFile, PreparedPlacard, Site
+
+NAMES = ['Alpha', 'Bravo', 'Charlie']
+
+
+pytestmark = pytest.mark.usefixtures('workspace')
+
+
+@pytest.fixture
+def drive():
+    return FakeDrive()
+
+
+@pytest.fixture
+def root_id(drive):
+    return drive.add_folder('Placards')
+
+
+def make_site() -> Site:
+    site = Site('Test', os.path.join(os.curdir, 'prepared'))
+    for name in NAMES:
+        placard_dir = site.placard_dir('Brewer', name)
+        os.makedirs(placard_dir, exist_ok=True)
+        png_path = os.path.join(placard_dir, 'placard.png')
+        with open(png_path, 'wb') as f:
+            f.write(f'png of {name}'.encode('utf8'))
+        hashes = Hashes(placard_dir)
+        hashes.add_output(png_path)
+        placard = PreparedPlacard(name, placard_dir)
+        placard.output_files['PNG'] = OutputFile('PNG', 'image/png', png_path, hashes)
+        site.prepared_placards.append(placard)
+    return site
+
+
+def sync(drive, root_id):
+    """Syncs like a fresh run would, returning {action: count} and the Drive
+    calls it made."""
+    drive.calls.clear()
+    results = GCloud(root_id, [make_site()], drive=drive).upload()
+    actions = {}
+    for result in results:
+        actions[result.action] = actions.get(result.action, 0) + 1
+    return (actions, dict(drive.calls))
+
+
+def uploaded(drive, name):
+    (item,) = [item for item in drive.list(f"name='{name}.png' and trashed=false")]
+    return item
+
+
+def test_first_sync(drive, root_id):
+    (actions, calls) = sync(drive, root_id)
+    assert actions == {UploadResult.CREATED: len(NAMES)}
+    assert calls['changes.getStartPageToken'] == 1
+    assert 'changes.list' not in calls
+    for name in NAMES:
+        assert uploaded(drive, name)['properties']['md5'] == drive.content_md5(uploaded(drive, name)['id'])
+
+
+def test_nothing_changed(drive, root_id):
+    sync(drive, root_id)
+    (actions, calls) = sync(drive, root_id)
+    assert actions == {UploadResult.UNCHANGED: len(NAMES)}
+    # Everything comes from the index and the (empty) changes since
+    assert calls == {'changes.list': 1}
+
+
+def test_remote_file_changed(drive, root_id):
+    sync(drive, root_id)
+    # Someone else replaces one of the files
+    changed = uploaded(drive, 'Bravo')
+    drive.update(changed['id'], {'properties': {'md5': 'edited elsewhere'}})
+
+    (actions, calls) = sync(drive, root_id)
+    assert actions == {UploadResult.UPDATED: 1, UploadResult.UNCHANGED: len(NAMES) - 1}
+    assert calls == {'changes.list': 1, 'files.update': 1}
+    assert uploaded(drive, 'Bravo')['id'] == changed['id']
+    assert uploaded(drive, 'Bravo')['properties']['md5'] != 'edited elsewhere'
+
+
+def test_changes_token_expired(drive, root_id):
+    sync(drive, root_id)
+    drive.expire_token()
+
+    (actions, calls) = sync(drive, root_id)
+    # Starts the index over and relists rather than uploading everything again
+    assert actions == {UploadResult.UNCHANGED: len(NAMES)}
+    assert calls['changes.getStartPageToken'] == 1
+    assert calls['files.list'] >= 1
+    assert 'files.create' not in calls and 'files.update' not in calls
+    assert len(drive.list("name='Alpha.png' and trashed=false")) == 1
@@ -1,46 +1,267 @@
 import argparse
+import contextlib
+import io
+import json
 import os.path
 import os
 import re
+import stat
+import threading
+import time
 
 from datetime import datetime
-from hashlib import md5
-from typing import Dict, List
-from PyPDF2 import PdfReader, PdfWriter
-from PyPDF2.generic import createStringObject, NameObject
+from hashlib import md5, sha256
+from typing import Dict, List, Optional, Tuple
+
+from manifest import get_manifest
 
 
 class Status:
+    """Nested status line.  Each thread keeps its own stack of messages so that
+    placards prepared concurrently don't clobber each other's context.
+
+    Once trace() is called, every push/pop pair (and span()) is also recorded
+    as a timed span that can be exported with write_trace().
+    """
+
     def __init__(self):
-        self.__stack = []
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
         self.__sep = ' : '
         self.__endl = '\r'
-
-    def push(self, message: str):
-        self.__stack.append(message)
+        self.__spans = None
+        self.__trace_start = None
+
+    def __stack(self) -> List[str]:
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+            self.__local.opened = []
+        return self.__local.stack
+
+    def push(self, message: str, **args):
+        """args are recorded with the span when tracing."""
+        stack = self.__stack()
+        stack.append(message)
+        self.__local.opened.append((time.perf_counter_ns(), args))
         self.write()
 
     def pop(self):
-        if len(self.__stack) > 0:
-            self.__stack.pop()
+        stack = self.__stack()
+        if len(stack) > 0:
+            self.__record(stack, *self.__local.opened.pop())
+            stack.pop()
             self.write()
 
     def clear(self):
-        self.__stack = []
+        stack = self.__stack()
+        while len(stack) > 0:
+            self.__record(stack, *self.__local.opened.pop())
+            stack.pop()
         self.write()
 
+    @contextlib.contextmanager
+    def span(self, message: str, **args):
+        self.push(message, **args)
+        try:
+            yield
+        finally:
+            self.pop()
+
     def write(self, message: str = None):
         addl = [message] if message is not None else []
-        print(f'{self.__sep.join(self.__stack + addl)}',
-              end=f'\033[K{self.__endl}')
+        with self.__lock:
+            print(f'{self.__sep.join(self.__stack() + addl)}',
+                  end=f'\033[K{self.__endl}')
 
     def debug(self, enable):
         self.__endl = '\n' if enable else '\r'
 
+    def trace(self):
+        """Starts recording spans."""
+        with self.__lock:
+            self.__spans = []
+            self.__trace_start = time.perf_counter_ns()
+
+    def __record(self, stack: List[str], start_ns: int, args: dict):
+        if self.__spans is None:
+            return
+        span = {
+            'name': stack[-1],
+            'stack': list(stack),
+            'thread': threading.current_thread().name,
+            'start_us': (start_ns - self.__trace_start) // 1000,
+            'duration_us': (time.perf_counter_ns() - start_ns) // 1000,
+        }
+        if args:
+            span['args'] = args
+        with self.__lock:
+            self.__spans.append(span)
+
+    def write_trace(self, trace_path: str):
+        """Writes the recorded spans as JSON lines if trace_path ends in
+        .jsonl, otherwise as a Chrome trace (chrome://tracing, Perfetto)."""
+        with self.__lock:
+            spans = sorted(self.__spans or [], key=lambda span: span['start_us'])
+        with open(trace_path, 'w') as f:
+            if trace_path.endswith('.jsonl'):
+                for span in spans:
+                    f.write(json.dumps(span) + '\n')
+                return
+
+            threads = {}
+            events = []
+            for span in spans:
+                tid = threads.setdefault(span['thread'], len(threads) + 1)
+                events.append({
+                    'name': span['name'],
+                    'cat': span['stack'][0],
+                    'ph': 'X',
+                    'ts': span['start_us'],
+                    'dur': span['duration_us'],
+                    'pid': 1,
+                    'tid': tid,
+                    'args': dict(span.get('args', {}), stack=self.__sep.join(span['stack'])),
+                })
+            for thread, tid in threads.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': tid, 'args': {'name': thread}})
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def trace_summary(self, count: int = 10) -> str:
+        """The slowest placards and commands, and where the time went overall."""
+        with self.__lock:
+            spans = list(self.__spans or [])
+        lines = []
+
+        # Workers have stacks of their own, stages are what the main thread
+        # spends its time on
+        stages = {}
+        for span in spans:
+            if len(span['stack']) == 1 and span['thread'] == threading.main_thread().name:
+                stages[span['name']] = stages.get(span['name'], 0) + span['duration_us']
+        lines.append('Slowest stages:')
+        for name, duration in sorted(stages.items(), key=lambda item: -item[1])[:count]:
+            lines.append(f'  {duration / 1e6:8.3f}s  {name}')
+
+        placards = [span for span in spans if 'placard' in span.get('args', {})]
+        if placards:
+            lines.append('Slowest placards:')
+            for span in sorted(placards, key=lambda span: -span['duration_us'])[:count]:
+                args = span['args']
+                lines.append(
+                    f'  {span["duration_us"] / 1e6:8.3f}s  {args["placard"]} ({args.get("site")})')
+
+        commands = [span for span in spans if 'command' in span.get('args', {})]
+        if commands:
+            lines.append('Slowest commands:')
+            for span in sorted(commands, key=lambda span: -span['duration_us'])[:count]:
+                lines.append(
+                    f'  {span["duration_us"] / 1e6:8.3f}s  {span["args"]["command"]}')
+        return '\n'.join(lines)
+
 
 status = Status()
 
 
+class FileHashCache:
+    """md5s of files, keyed by (path, size, mtime_ns, inode).
+
+    A file whose stat hasn't changed is never read again, either within a run
+    or, once load()ed, across runs.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    # A file modified this recently (ns) could still change without its stat
+    # changing, so its hash is only trusted for the rest of this run.
+    RACY_NS = 2 * 1000 * 1000 * 1000
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__cache_path = None
+        self.__dirty = False
+
+    def load(self, cache_path: str):
+        with self.__lock:
+            self.__cache_path = cache_path
+            if not os.path.isfile(cache_path):
+                return
+            with open(cache_path, 'r') as f:
+                for path, (size, mtime_ns, inode, hash) in json.load(f).items():
+                    self.__entries[path] = ((size, mtime_ns, inode), hash, True)
+
+    def save(self):
+        with self.__lock:
+            if self.__cache_path is None or not self.__dirty:
+                return
+            entries = {path: [*key, hash] for path, (key, hash, persist)
+                       in self.__entries.items() if persist}
+            temp_path = f'{self.__cache_path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(entries, f, sort_keys=True)
+            os.replace(temp_path, self.__cache_path)
+            self.__dirty = False
+
+    def hash(self, file_path: str):
+        """Returns the md5 of file_path, or None if it isn't a file."""
+        path = os.path.abspath(file_path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self.__lock:
+            entry = self.__entries.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        digest = md5()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(self.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        hash = digest.hexdigest()
+
+        persist = time.time_ns() - st.st_mtime_ns > self.RACY_NS
+        with self.__lock:
+            self.__entries[path] = (key, hash, persist)
+            self.__dirty = True
+        return hash
+
+
+file_hashes = FileHashCache()
+
+
+class OutputSavings:
+    """Tally, by output type, of the bytes that optimizing outputs saved."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__totals: Dict[str, List[int]] = {}
+
+    def add(self, type: str, before: int, after: int):
+        with self.__lock:
+            totals = self.__totals.setdefault(type, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += before
+            totals[2] += after
+
+    def summary(self) -> Optional[str]:
+        with self.__lock:
+            if not self.__totals:
+                return None
+            lines = ['Output optimization:']
+            for type, (count, before, after) in sorted(self.__totals.items()):
+                saved = before - after
+                lines.append(
+                    f'  {count} {type}(s): {before:,} -> {after:,} bytes, saved {saved:,} ({saved / max(before, 1):.1%})')
+            return '\n'.join(lines)
+
+
+output_savings = OutputSavings()
+
+
 class Hashes:
     class HashedData:
         def __init__(self, data):
@@ -56,29 +277,31 @@ class Hashes:
             self.__hash = None
 
         def hash(self):
-            real_path = os.path.join(
-                self.__hash_root_dir, self.__rel_file_path)
-            if os.path.isfile(real_path):
-                with open(real_path, 'rb+') as file:
-                    return md5(file.read()).hexdigest()
-            return None
+            return file_hashes.hash(os.path.join(
+                self.__hash_root_dir, self.__rel_file_path))
 
-    def __init__(self, hash_file_path: str):
-        self.__hash_file_path = hash_file_path
+    def __init__(self, placard_dir: str):
+        self.__placard_dir = placard_dir
+        self.__placard = get_manifest().placard_key(placard_dir)
         self.__blobs = {}
         self.__files = {}
+        self.__kinds = {}
         self.__loaded = {}
         self.__is_loaded = False
 
     def add_blob(self, blob_name: str, hashable_data):
         self.__blobs[blob_name] = Hashes.HashedData(hashable_data)
+        self.__kinds[blob_name] = 'blob'
 
-    def add_file(self, file_path: str):
-        relpath = os.path.relpath(
-            file_path, os.path.dirname(self.__hash_file_path))
-        if not file_path in self.__files:
+    def add_file(self, file_path: str, kind: str = 'file'):
+        relpath = os.path.relpath(file_path, self.__placard_dir)
+        if not relpath in self.__files:
             self.__files[relpath] = Hashes.HashedFile(
-                os.path.dirname(self.__hash_file_path), relpath)
+                self.__placard_dir, relpath)
+            self.__kinds[relpath] = kind
+
+    def add_output(self, file_path: str):
+        self.add_file(file_path, 'output')
 
     def has_changes(self, name: str = None) -> bool:
         self.__load()
@@ -102,29 +325,25 @@ class Hashes:
 
     def save(self):
         combined = self.__blobs | self.__files
-        with open(self.__hash_file_path, 'w+') as file:
-            for name in combined:
-                file.write(f'{name}:{combined[name].hash()}\n')
+        get_manifest().save(self.__placard, {
+            name: (self.__kinds[name], combined[name].hash()) for name in combined})
 
     def __load(self):
         if self.__is_loaded:
             return
         self.__is_loaded = True
-
-        if not os.path.isfile(self.__hash_file_path):
-            return
-
-        with open(self.__hash_file_path, 'r+') as f:
-            self.__loaded = {h[0]: h[1]
-                             for h in (l.split(':') for l in f.read().splitlines())}
+        self.__loaded = get_manifest().load(self.__placard)
 
     def get_hash(self, file_path):
-        relpath = os.path.relpath(
-            file_path, os.path.dirname(self.__hash_file_path))
+        relpath = os.path.relpath(file_path, self.__placard_dir)
         if not relpath in self.__files:
             raise Exception(f'No hash info for {relpath} (from {file_path})')
         return self.__files[relpath].hash()
 
+    def record_upload(self, file_path, hash):
+        get_manifest().record_upload(
+            self.__placard, os.path.relpath(file_path, self.__placard_dir), hash)
+
 
 _singleton = None
 _description = ""
@@ -146,53 +365,128 @@ def ArgumentParser(description=None, *arg_l, **arg_d):
                                 action=argparse.BooleanOptionalAction, help='Do not overwrite status messages during execution')
         _singleton.add_argument('--beer', default=None,
                                 help='Only process beers with this exact name')
+        _singleton.add_argument('--jobs', default=1, type=int,
+                                help='Number of placards to prepare concurrently')
+        _singleton.add_argument('--trace', default=None,
+                                help='Record timed spans of the run to this file, as a Chrome trace (or JSON lines if it ends in .jsonl), and print a summary')
 
     return _singleton
 
 
-def syscmd(cmd):
-    parser = ArgumentParser()
-    args = parser.parse_args()
-    redirect = '' if args.debug else ' > /dev/null 2>&1'
-    return os.system(f'{cmd} {redirect}')
-
-
-def make_hash_stable_pdf(pdf_path):
-    # Get rid of dynamic ids
-    pdf_path_cleansed = f'{pdf_path}.cleansed'
-    if syscmd(f'qpdf --static-id --pages {pdf_path} 1-z -- --empty {pdf_path_cleansed}') != 0:
-        raise Exception(
-            f'Failed to make pdf hash-stable.  Do you have qpdf installed?')
-
-    # Kill creator and date-related metadata buried way down in the doc by Chrome's PDF renderer
-    blank = u'blank'
-    blank_date = u"D:20220101000000+00'00'"
-    reader = PdfReader(pdf_path_cleansed)
+# Whitespace, in points, left around cropped placard PDFs
+PDF_CROP_MARGIN = 24
+
+
+def _content_digest(obj, digest):
+    # Feeds obj, with indirect references followed, into digest so that
+    # copies of an object from different documents digest the same
+    from PyPDF2.generic import ArrayObject, DictionaryObject, StreamObject
+    obj = obj.get_object()
+    if isinstance(obj, DictionaryObject):
+        digest.update(b'<<')
+        for key in sorted(obj.keys()):
+            if key == '/Length':
+                continue
+            digest.update(key.encode('utf8'))
+            _content_digest(obj.raw_get(key), digest)
+        digest.update(b'>>')
+        if isinstance(obj, StreamObject):
+            digest.update(obj._data)
+    elif isinstance(obj, ArrayObject):
+        digest.update(b'[')
+        for item in obj:
+            _content_digest(item, digest)
+        digest.update(b']')
+    else:
+        digest.update(f'{type(obj).__name__}:{obj}'.encode('utf8'))
+
+
+def dedupe_pdf_images(pages) -> int:
+    """Points every use of an image XObject with the same content (from any
+    page, form or source document) at a single copy of it, so the image is
+    only written once.  Returns the bytes of image data no longer written."""
+    seen = {}
+    visited = set()
+    saved = 0
+
+    def dedupe_resources(resources):
+        nonlocal saved
+        xobjects = resources.get('/XObject') if resources is not None else None
+        if xobjects is None:
+            return
+        xobjects = xobjects.get_object()
+        for name in list(xobjects.keys()):
+            reference = xobjects.raw_get(name)
+            xobject = reference.get_object()
+            if id(xobject) in visited:
+                continue
+            visited.add(id(xobject))
+            if xobject.get('/Subtype') == '/Image':
+                digest = sha256()
+                _content_digest(xobject, digest)
+                key = digest.digest()
+                if key in seen:
+                    xobjects[name] = seen[key]
+                    saved += len(xobject._data)
+                else:
+                    seen[key] = reference
+            elif xobject.get('/Subtype') == '/Form':
+                dedupe_resources(xobject.get('/Resources'))
+
+    for page in pages:
+        dedupe_resources(page.get('/Resources'))
+    return saved
+
+
+def write_hash_stable_pdf(pdf_data: bytes, pdf_path: str, margin: float = 0) -> int:
+    """Writes pdf_data to pdf_path with every page grown by margin points on
+    each side and without anything that changes between identical renders.
+    Returns the bytes saved by writing each image only once.
+
+    Only the pages are copied across, so the document ID, /Info dictionary
+    (Creator, Producer, dates) and XMP metadata of the source never make it
+    into the output.
+    """
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import FloatObject, NameObject, RectangleObject
+    reader = PdfReader(io.BytesIO(pdf_data))
     writer = PdfWriter()
-    for page_num in range(len(reader.pages)):
-        infoDict = reader.flattened_pages[page_num].get_object(
-        )['/Resources']['/XObject']['/Im1']['/PTEX.InfoDict']
-        infoDict[NameObject('/Creator')] = createStringObject(blank)
-        infoDict[NameObject('/CreationDate')] = createStringObject(blank_date)
-        infoDict[NameObject('/ModDate')] = createStringObject(blank_date)
-        infoDict[NameObject('/Producer')] = createStringObject(blank)
-        writer.add_page(reader.flattened_pages[page_num])
+    for page in reader.pages:
+        box = page.mediabox
+        cropped = RectangleObject([FloatObject(f'{v:.4f}') for v in [
+            float(box.left) - margin, float(box.bottom) - margin,
+            float(box.right) + margin, float(box.top) + margin]])
+        page[NameObject('/MediaBox')] = cropped
+        page[NameObject('/CropBox')] = cropped
+        for key in ['/TrimBox', '/BleedBox', '/ArtBox', '/Metadata', '/PieceInfo', '/LastModified']:
+            if key in page:
+                del page[key]
+        writer.add_page(page)
+    saved = dedupe_pdf_images(writer.pages)
+    # The writer always stamps itself as the producer
+    writer.add_metadata({'/Producer': ''})
     with open(pdf_path, 'wb') as output_stream:
         writer.write(output_stream)
-
-    os.remove(pdf_path_cleansed)
+    return saved
 
 
 class OutputFile:
-    def __init__(self, type, mime_type, file_path, hashes: Hashes):
+    def __init__(self, type, mime_type, file_path, hashes: Hashes, hash: str = None):
         self.type = type
         self.mime_type = mime_type
         self.file_path = file_path
         self.__hashes: Hashes = hashes
+        # Set when the hash is already known to be current
+        self.__hash = hash
 
     def get_hash(self):
+        if self.__hash is not None:
+            return self.__hash
         return self.__hashes.get_hash(self.file_path)
 
+    def record_upload(self, hash):
+        self.__hashes.record_upload(self.file_path, hash)
+
 
 class PreparedPlacard:
     def __init__(self, name: str, placard_dir: str):
@@ -202,18 +496,107 @@ class PreparedPlacard:
         self.placard_dir = placard_dir
 
 
+class RecordedPlacard(PreparedPlacard):
+    """A placard that is known to be up to date, restored from the record
+    saved when it was last built instead of from its files."""
+
+    def __init__(self, record: dict):
+        super().__init__(record['name'], record['placard_dir'])
+        hashes = Hashes(self.placard_dir)
+        for (type, mime_type, rel_path, hash) in record['outputs']:
+            self.output_files[type] = OutputFile(
+                type, mime_type, os.path.join(self.placard_dir, rel_path), hashes, hash)
+
+
+def _stat_fingerprint(values: List[str], paths: List[str]) -> str:
+    # Cheap stand-in for hashing the contents of paths: any write to (or
+    # removal of) one of them changes its stat.
+    digest = md5()
+    digest.update(json.dumps(values).encode('utf8'))
+    for path in paths:
+        try:
+            st = os.stat(path)
+            key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        except FileNotFoundError:
+            key = None
+        digest.update(json.dumps([path, key]).encode('utf8'))
+    return digest.hexdigest()
+
+
 class Site:
     def __init__(self, name, prepared_dir):
         self.name = name
         self.site_dir = os.path.join(prepared_dir, self._safe_path(name))
         self.prepared_placards: List[PreparedPlacard] = []
 
+    def output_types(self) -> Dict[str, str]:
+        """Type -> mime type of the outputs of this site's placards, which is
+        also the Drive folder each is uploaded to.  Sites that know their
+        types up front should say so, otherwise they are taken from the
+        placards prepared so far."""
+        types = {}
+        for placard in self.prepared_placards:
+            for name, output_file in placard.output_files.items():
+                if not name in types:
+                    types[name] = output_file.mime_type
+                elif types[name] != output_file.mime_type:
+                    raise Exception(
+                        f'Mismatched upload folder mime type for {name}.  Both {types[name]} and {output_file.mime_type} use that name.')
+        return types
+
+    def placard_dir(self, brewer: str, beer: str) -> str:
+        return os.path.join(self.site_dir, self._safe_path(f'{brewer}_{beer}'))
+
+    def restore_placard(self, row: List[str]) -> Optional[PreparedPlacard]:
+        """Returns the placard last built from row if neither row nor anything
+        else it was built from has changed since, without reading any files."""
+        placard_dir = self.placard_dir(row[0], row[1])
+        saved = get_manifest().load_row(get_manifest().placard_key(placard_dir))
+        if saved is None:
+            return None
+        (fingerprint, record) = saved
+        output_paths = [os.path.join(placard_dir, rel_path)
+                        for (_, _, rel_path, _) in record['outputs']]
+        if fingerprint != self.__fingerprint(row, placard_dir, output_paths):
+            return None
+        return RecordedPlacard(record)
+
+    def record_placard(self, row: List[str], placard: PreparedPlacard):
+        """Remembers what placard was built from so that restore_placard can
+        skip it next time."""
+        outputs = [(output_file.type, output_file.mime_type,
+                    os.path.relpath(output_file.file_path, placard.placard_dir), output_file.get_hash())
+                   for output_file in placard.output_files.values()]
+        if any(hash is None for (_, _, _, hash) in outputs):
+            return
+        record = {'name': placard.name,
+                  'placard_dir': placard.placard_dir, 'outputs': outputs}
+        fingerprint = self.__fingerprint(
+            row, placard.placard_dir, [output_file.file_path for output_file in placard.output_files.values()])
+        get_manifest().save_row(get_manifest().placard_key(
+            placard.placard_dir), fingerprint, record)
+
+    def __fingerprint(self, row: List[str], placard_dir: str, output_paths: List[str]) -> str:
+        (values, input_paths) = self._fingerprint_inputs(placard_dir)
+        return _stat_fingerprint([self.name] + list(row) + values, input_paths + output_paths)
+
+    def _fingerprint_inputs(self, placard_dir: str) -> Tuple[List[str], List[str]]:
+        """Values and files, besides the sheet row and the outputs, that the
+        placard in placard_dir is built from."""
+        return ([], [])
+
     def prepare_placard(self, brewer: str, beer: str, style: str, abv_str: str, logo_url: str, brewery_font_size: str, beer_font_size: str, style_font_size: str) -> PreparedPlacard:
-        placard = self._do_prepare_placard(
+        placard = self.build_placard(
             brewer, beer, style, abv_str, logo_url, brewery_font_size, beer_font_size, style_font_size)
         self.prepared_placards.append(placard)
         return placard
 
+    def build_placard(self, brewer: str, beer: str, style: str, abv_str: str, logo_url: str, brewery_font_size: str, beer_font_size: str, style_font_size: str) -> PreparedPlacard:
+        # Does not touch prepared_placards, so it is safe to call concurrently.
+        # Callers are responsible for recording the result in order.
+        return self._do_prepare_placard(
+            brewer, beer, style, abv_str, logo_url, brewery_font_size, beer_font_size, style_font_size)
+
     def _safe_path(self, path: str):
         return re.sub('[^a-zA-Z0-9_-]', '_', path.lower())
 